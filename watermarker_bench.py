@@ -0,0 +1,378 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from PIL import Image, ImageChops, ImageDraw
+import watermarker_engine as engine
+import watermarker_numpy
+
+"""
+Watermarker Pro Benchmarks
+--------------------------
+Відтворюваний замір гарячих шляхів рушія на синтетичних даних (без мережі):
+
+    python watermarker_bench.py --suite quick -o bench.json
+    python watermarker_bench.py --suite quick --baseline bench.json
+
+Кожен сценарій виконується в окремому процесі, тож пікова RSS не змішується
+між сценаріями, а кеші рушія стартують холодними.
+"""
+
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'fonts')
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "wm_bench_data")
+
+# name -> (розмір, формат, чи є альфа)
+INPUTS = {
+    'jpeg12': ((4240, 2832), 'JPEG', False),
+    'jpeg24': ((6000, 4000), 'JPEG', False),
+    'jpeg48': ((8480, 5656), 'JPEG', False),
+    'png_alpha': ((3000, 2000), 'PNG', True),
+    'webp': ((4000, 3000), 'WEBP', False),
+}
+RESIZES = {
+    'fhd': {'enabled': True, 'mode': 'Max Side', 'value': 1920},
+    'width1280': {'enabled': True, 'mode': 'Exact Width', 'value': 1280},
+    'none': {'enabled': False},
+}
+POSITIONS = {
+    'corner': {'wm_position': 'bottom-right', 'wm_angle': 0, 'wm_opacity': 1.0},
+    'center': {'wm_position': 'center', 'wm_angle': 0, 'wm_opacity': 1.0},
+    'tiled45': {'wm_position': 'tiled', 'wm_angle': 45, 'wm_opacity': 0.3, 'wm_gap': 30},
+}
+FORMATS = ('JPEG', 'WEBP', 'PNG')
+COMPOSITORS = [c for c in engine.COMPOSITORS if c == 'pil' or watermarker_numpy.AVAILABLE]
+
+# Допустима розбіжність альтернативного компонувальника з PIL (на канал, 0..255)
+PARITY_TOLERANCE = 2
+
+# Джерела для звірки режиму смуг з цілим кадром: name -> (файл, чи декодується смугами)
+STRIP_INPUTS = {
+    'png_palette_trns': ('strip_palette_trns.png', True),
+    'png_rgb_trns': ('strip_rgb_trns.png', True),
+    'png16': ('strip_16bit.png', False),
+    'png_interlaced': ('strip_interlaced.png', False),
+    'tiff_raw': ('strip_raw.tif', True),
+    'tiff_lzw': ('strip_lzw.tif', True),
+    'tiff_deflate': ('strip_deflate.tif', True),
+}
+STRIP_INPUT_SIZE = (1600, 1000)
+
+BASE_SCENARIO = {'input': 'jpeg24', 'resize': 'fhd', 'position': 'corner', 'format': 'JPEG',
+                 'workers': 1, 'backend': 'thread'}
+
+def _synthetic_image(size: tuple, alpha: bool) -> Image.Image:
+    """Детермінований кадр із градієнтами та фракталом (без випадкового шуму)."""
+    w, h = size
+    r = Image.linear_gradient('L').resize(size)
+    g = Image.radial_gradient('L').resize(size)
+    b = Image.effect_mandelbrot((w // 4, h // 4), (-2.0, -1.2, 0.8, 1.2), 256).resize(size)
+    img = Image.merge('RGB', (r, g, b))
+    draw = ImageDraw.Draw(img)
+    for x in range(0, w, max(1, w // 60)):
+        draw.line((x, 0, w - x, h), fill=(x % 256, 255 - x % 256, 128), width=3)
+    if alpha:
+        img = img.convert('RGBA')
+        img.putalpha(Image.radial_gradient('L').resize(size).point(lambda v: 255 - v))
+    return img
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+def _save_interlaced_png(img: Image.Image, path: str):
+    """RGB PNG з Adam7 (Pillow такі не пише): сім проходів, рядки з фільтром None."""
+    w, h = img.size
+    data = img.tobytes()
+    raw = []
+    for x0, y0, dx, dy in ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)):
+        if x0 >= w: continue
+        for y in range(y0, h, dy):
+            row = data[y * w * 3:(y + 1) * w * 3]
+            raw.append(b"\x00" + b"".join(row[x * 3:x * 3 + 3] for x in range(x0, w, dx)))
+    ihdr = struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 1)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", ihdr) + _png_chunk(b"IDAT", zlib.compress(b"".join(raw)))
+                + _png_chunk(b"IEND", b""))
+
+def ensure_strip_inputs(data_dir: str) -> dict:
+    """Малі джерела всіх видів, які режим смуг має або декодувати смугами, або віддати цілому кадру."""
+    paths = {name: os.path.join(data_dir, file_name) for name, (file_name, _) in STRIP_INPUTS.items()}
+    if all(os.path.exists(p) for p in paths.values()): return paths
+    img = _synthetic_image(STRIP_INPUT_SIZE, False)
+    keyed = img.copy()
+    keyed.paste((0, 255, 0), (200, 200, 900, 700))
+    keyed.save(paths['png_rgb_trns'], transparency=(0, 255, 0))
+    palette = img.quantize(64)
+    palette.save(paths['png_palette_trns'], transparency=0)
+    img.convert('L').convert('I').point(lambda v: v * 257).save(paths['png16'])
+    _save_interlaced_png(img, paths['png_interlaced'])
+    img.save(paths['tiff_raw'])
+    img.save(paths['tiff_lzw'], compression='tiff_lzw')
+    img.save(paths['tiff_deflate'], compression='tiff_adobe_deflate', tiffinfo={317: 2})
+    return paths
+
+def ensure_inputs(data_dir: str) -> dict:
+    os.makedirs(data_dir, exist_ok=True)
+    paths = {}
+    for name, (size, fmt, alpha) in INPUTS.items():
+        path = os.path.join(data_dir, f"{name}.{fmt.lower()}")
+        if not os.path.exists(path):
+            img = _synthetic_image(size, alpha)
+            save_kwargs = {'quality': 90} if fmt != 'PNG' else {}
+            if fmt == 'JPEG':
+                exif = Image.Exif()
+                exif[0x0112] = 1
+                save_kwargs['exif'] = exif.tobytes()
+            img.save(path + ".part", fmt, **save_kwargs)
+            os.replace(path + ".part", path)
+        paths[name] = path
+    logo_path = os.path.join(data_dir, "logo.png")
+    if not os.path.exists(logo_path):
+        logo = Image.new('RGBA', (600, 240), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(logo)
+        draw.rounded_rectangle((0, 0, 599, 239), 40, fill=(255, 255, 255, 200), outline=(0, 0, 0, 255), width=8)
+        logo.save(logo_path)
+    paths['logo'] = logo_path
+    return paths
+
+def scenario_name(sc: dict) -> str:
+    if sc.get('kind') == 'micro': return f"micro|{sc['target']}"
+    name = f"{sc['input']}|{sc['resize']}|{sc['position']}|{sc['format']}|{sc['backend']}x{sc['workers']}"
+    # Базовий компонувальник не додається до імені, щоб старі baseline-файли лишались порівнюваними
+    compositor = sc.get('compositor', engine.DEFAULT_COMPOSITOR)
+    return name if compositor == engine.DEFAULT_COMPOSITOR else f"{name}|{compositor}"
+
+def build_suite(suite: str, max_workers: int) -> list:
+    """
+    quick: від базового сценарію змінюється один вимір за раз.
+    full: повний декартів добуток усіх вимірів.
+    """
+    workers = sorted({1, max_workers})
+    scenarios = []
+    if suite == 'full':
+        for inp, rs, pos, fmt, wk in itertools.product(INPUTS, RESIZES, POSITIONS, FORMATS, workers):
+            scenarios.append({'input': inp, 'resize': rs, 'position': pos, 'format': fmt,
+                              'workers': wk, 'backend': 'thread'})
+    else:
+        sweeps = {'input': INPUTS, 'resize': RESIZES, 'position': POSITIONS, 'format': FORMATS, 'workers': workers}
+        for key, values in sweeps.items():
+            for value in values:
+                sc = dict(BASE_SCENARIO, **{key: value})
+                if sc not in scenarios: scenarios.append(sc)
+    # Альтернативні компонувальники — на всіх позиціях і на прозорому вході
+    for compositor in COMPOSITORS:
+        if compositor == engine.DEFAULT_COMPOSITOR: continue
+        for pos in POSITIONS:
+            scenarios.append(dict(BASE_SCENARIO, position=pos, compositor=compositor))
+        scenarios.append(dict(BASE_SCENARIO, input='png_alpha', compositor=compositor))
+    for backend in engine.BACKENDS:
+        if max_workers > 1:
+            sc = dict(BASE_SCENARIO, workers=max_workers, backend=backend)
+            if sc not in scenarios: scenarios.append(sc)
+    scenarios += [{'kind': 'micro', 'target': 'get_thumbnail'},
+                  {'kind': 'micro', 'target': 'create_text_watermark'},
+                  {'kind': 'micro', 'target': 'strip_parity'}]
+    return scenarios
+
+def _percentile(values: list, pct: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss у КБ на Linux і в байтах на macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / scale
+
+def _summarize(latencies: list, count: int, elapsed: float) -> dict:
+    return {
+        'images': count,
+        'seconds': elapsed,
+        'images_per_sec': count / elapsed if elapsed else 0.0,
+        'p50_ms': _percentile(latencies, 50),
+        'p90_ms': _percentile(latencies, 90),
+        'p99_ms': _percentile(latencies, 99),
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+def run_micro(sc: dict, paths: dict, images: int) -> dict:
+    latencies = []
+    work_dir = tempfile.mkdtemp(prefix="wm_bench_")
+    try:
+        started = time.perf_counter()
+        for i in range(images):
+            t = time.perf_counter()
+            if sc['target'] == 'get_thumbnail':
+                src = os.path.join(work_dir, f"thumb_{i}.jpg")
+                shutil.copyfile(paths['jpeg24'], src)
+                engine.get_thumbnail(src)
+            else:
+                fonts = [f for f in sorted(os.listdir(FONT_DIR)) if f.endswith('.ttf')] if os.path.isdir(FONT_DIR) else []
+                font_path = os.path.join(FONT_DIR, fonts[0]) if fonts else None
+                engine.create_text_watermark(f"© Watermarker Pro {i}", font_path, 100, '#FFFFFF')
+            latencies.append((time.perf_counter() - t) * 1000)
+        return _summarize(latencies, images, time.perf_counter() - started)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def parity_diff(src: str, wm_obj, cfg: dict) -> int:
+    """Найбільша розбіжність каналу між cfg['compositor'] і PIL (обидва в PNG, без втрат)."""
+    frames = []
+    for compositor in (cfg['compositor'], 'pil'):
+        data, _ = engine.Pipeline(wm_obj, dict(cfg, compositor=compositor), 'PNG').render(src, "parity")
+        frames.append(Image.open(io.BytesIO(data)).convert('RGBA'))
+    return max(hi for _, hi in ImageChops.difference(*frames).getextrema())
+
+def run_strip_parity(data_dir: str, wm_obj) -> dict:
+    """
+    Режим смуг проти цілого кадру на STRIP_INPUTS: найбільша розбіжність каналу (PNG без втрат)
+    і чи обрано той читач смуг, який очікується. Поріг смуг знижено, тож смуги беруть і малі кадри.
+    """
+    latencies, diffs, errors = [], {}, []
+    started = time.perf_counter()
+    large_pixels = engine.LARGE_IMAGE_PIXELS
+    engine.LARGE_IMAGE_PIXELS = 1
+    try:
+        for name, path in ensure_strip_inputs(data_dir).items():
+            t = time.perf_counter()
+            with Image.open(path) as img:
+                reader = engine._row_reader(img, path, 0, 2**20)
+            if reader: reader.close()
+            if bool(reader) != STRIP_INPUTS[name][1]:
+                errors.append(f"{name}: {'streamed' if reader else 'not streamed'}")
+            frames = []
+            for strip_mb in (1, 0):
+                cfg = {'enabled': True, 'value': 700, 'wm_scale': 0.15, 'strip_memory_mb': strip_mb}
+                data, _ = engine.Pipeline(wm_obj, cfg, 'PNG').render(path, name)
+                frames.append(Image.open(io.BytesIO(data)).convert('RGBA'))
+            diffs[name] = max(hi for _, hi in ImageChops.difference(*frames).getextrema())
+            latencies.append((time.perf_counter() - t) * 1000)
+    finally:
+        engine.LARGE_IMAGE_PIXELS = large_pixels
+    result = _summarize(latencies, len(latencies), time.perf_counter() - started)
+    result.update(parity_max_diff=max(diffs.values()), parity=diffs, parity_errors=errors)
+    return result
+
+def run_scenario(sc: dict, paths: dict, images: int) -> dict:
+    if sc.get('kind') == 'micro' and sc['target'] == 'strip_parity':
+        return run_strip_parity(os.path.dirname(paths['logo']),
+                                engine.load_watermark_from_file(open(paths['logo'], 'rb').read()))
+    if sc.get('kind') == 'micro': return run_micro(sc, paths, images)
+    wm_obj = engine.load_watermark_from_file(open(paths['logo'], 'rb').read())
+    cfg = dict(RESIZES[sc['resize']], wm_scale=0.15, wm_margin=15, **POSITIONS[sc['position']],
+               compositor=sc.get('compositor', engine.DEFAULT_COMPOSITOR))
+    out_dir = tempfile.mkdtemp(prefix="wm_bench_out_")
+    try:
+        ext = sc['format'].lower()
+        jobs = [(paths[sc['input']], os.path.join(out_dir, f"out_{i}.{ext}")) for i in range(images)]
+        latencies, failures = [], 0
+        started = time.perf_counter()
+        pipeline = engine.Pipeline(wm_obj, cfg, sc['format'], 85)
+        for _, stats, err in pipeline.run_many(jobs, sc['workers'], sc['backend']):
+            if err is None: latencies.append(stats['elapsed_ms'])
+            else: failures += 1
+        result = _summarize(latencies, len(latencies), time.perf_counter() - started)
+        result['failures'] = failures
+        if cfg['compositor'] != 'pil': result['parity_max_diff'] = parity_diff(paths[sc['input']], wm_obj, cfg)
+        return result
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+def run_isolated(sc: dict, data_dir: str, images: int) -> dict:
+    """Запускає сценарій у свіжому інтерпретаторі та читає JSON-результат зі stdout."""
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-one', json.dumps(sc),
+           '--data-dir', data_dir, '--images', str(images)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Повертає список регресій (сценарії, де img/s впали більше ніж на threshold %)."""
+    regressions = []
+    print(f"\n{'scenario':<58} {'img/s':>8} {'base':>8} {'delta':>8}")
+    for name, res in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base or 'error' in res or 'error' in base or not base.get('images_per_sec'):
+            continue
+        delta = (res['images_per_sec'] / base['images_per_sec'] - 1) * 100
+        flag = ''
+        if delta < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<58} {res['images_per_sec']:>8.2f} {base['images_per_sec']:>8.2f} {delta:>+7.1f}%{flag}")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Watermarker Pro engine benchmarks")
+    parser.add_argument('--suite', choices=['quick', 'full'], default='quick')
+    parser.add_argument('--images', type=int, default=8, help="Зображень на сценарій")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Максимум воркерів у розгортці")
+    parser.add_argument('--filter', help="Запускати лише сценарії, що містять цей підрядок")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help="Кеш синтетичних вхідних файлів")
+    parser.add_argument('-o', '--output', help="Зберегти результати в JSON")
+    parser.add_argument('--baseline', help="Порівняти з попереднім JSON")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Поріг регресії, %%")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    paths = ensure_inputs(args.data_dir)
+    if args.run_one:
+        print(json.dumps(run_scenario(json.loads(args.run_one), paths, args.images)))
+        return 0
+
+    scenarios = build_suite(args.suite, args.workers)
+    if args.filter: scenarios = [sc for sc in scenarios if args.filter in scenario_name(sc)]
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'numpy': watermarker_numpy.np.__version__ if watermarker_numpy.AVAILABLE else None,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'images_per_scenario': args.images,
+            'suite': args.suite,
+        },
+        'scenarios': {}
+    }
+    mismatches = []
+    print(f"{'scenario':<58} {'img/s':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'rss MB':>8}")
+    for sc in scenarios:
+        name = scenario_name(sc)
+        res = run_isolated(sc, args.data_dir, args.images)
+        results['scenarios'][name] = dict(res, config=sc)
+        if 'error' in res:
+            print(f"{name:<58} ERROR {res['error']}")
+        else:
+            parity = res.get('parity_max_diff')
+            flag = f"  PARITY {parity}" if parity is not None and parity > PARITY_TOLERANCE else ''
+            if res.get('parity_errors'): flag += f"  PARITY {'; '.join(res['parity_errors'])}"
+            if flag: mismatches.append(name)
+            print(f"{name:<58} {res['images_per_sec']:>8.2f} {res['p50_ms']:>8.1f} "
+                  f"{res['p90_ms']:>8.1f} {res['p99_ms']:>8.1f} {res['peak_rss_mb']:>8.0f}{flag}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold): return 1
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import watermarker_engine as engine
+
+"""
+Watermarker Pro CLI
+-------------------
+Пакетна обробка без браузера (нічні імпорти, великі архіви).
+
+    python watermarker_cli.py photos/ -p wm_preset_full.wmpreset -o out/ --workers 8 --resume
+"""
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff')
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'fonts')
+
+def collect_inputs(inputs: list, recursive: bool = False) -> list:
+    """Розгортає теки та glob-шаблони у відсортований список зображень."""
+    found = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, '**', '*') if recursive else os.path.join(item, '*')
+            candidates = glob.glob(pattern, recursive=recursive)
+        else:
+            candidates = glob.glob(item, recursive=recursive)
+        for path in candidates:
+            if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                found.add(os.path.abspath(path))
+    return sorted(found)
+
+def format_size(num_bytes: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if num_bytes < 1024: return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Watermarker Pro: headless batch processing")
+    parser.add_argument('inputs', nargs='+', help="Теки або glob-шаблони з фото")
+    parser.add_argument('-o', '--output', required=True, help="Тека для результатів")
+    parser.add_argument('-p', '--preset', help="Пресет (.wmpreset або старий .json), збережений у веб-додатку")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 2, help="Кількість воркерів")
+    parser.add_argument('--backend', choices=engine.BACKENDS, default='process', help="Потоки або процеси")
+    parser.add_argument('-r', '--recursive', action='store_true', help="Шукати фото у вкладених теках")
+    parser.add_argument('--resume', action='store_true', help="Пропускати файли, результат яких уже існує")
+    parser.add_argument('--format', choices=['JPEG', 'WEBP', 'PNG'], help="Перевизначити формат із пресету")
+    parser.add_argument('--quality', type=int, help="Перевизначити якість із пресету")
+    parser.add_argument('--encoder', choices=list(engine.ENCODER_PROFILES), help="Перевизначити профіль енкодера")
+    parser.add_argument('--compositor', choices=engine.COMPOSITORS,
+                        help="Реалізація накладання лого ('numpy' потребує NumPy)")
+    parser.add_argument('--target-kb', type=int, help="Цільовий розмір файлу (KB) для JPEG/WEBP; якість підбирається")
+    parser.add_argument('--renditions', nargs='+', choices=list(engine.RENDITION_SIZES),
+                        help="Набір версій з одного декодування (замість --size)")
+    parser.add_argument('--extra-formats', nargs='+', default=[], choices=['JPEG', 'WEBP', 'PNG'],
+                        help="Додаткові формати для --renditions")
+    parser.add_argument('--size', type=int, help="Перевизначити розмір (px) із пресету")
+    parser.add_argument('--resize-mode', default='Max Side', choices=['Max Side', 'Exact Width', 'Exact Height'])
+    parser.add_argument('--no-resize', action='store_true', help="Не змінювати розмір")
+    parser.add_argument('--memory-budget-mb', type=int,
+                        help="Бюджет RAM для паралельних jobs, МБ (за замовчуванням — частка доступної; 0 — вимкнено)")
+    parser.add_argument('--strip-memory-mb', type=int,
+                        help=f"Пам'ять на обробку смугами фото від {engine.LARGE_IMAGE_PIXELS // 10**6} МП, МБ (0 — вимкнено)")
+    parser.add_argument('--cache-dir', help="Тека дискового кешу результатів (повторні запуски не перекодовують)")
+    parser.add_argument('--cache-size-mb', type=int, default=engine.RESULT_CACHE_MAX_BYTES // 2**20,
+                        help="Межа розміру кешу результатів, МБ")
+    parser.add_argument('--profile', action='store_true', help="Додати в підсумок час за етапами обробки")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Лише підсумок")
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    try:
+        preset = engine.load_preset(args.preset) if args.preset else {}
+    except (OSError, ValueError) as e:
+        print(f"Preset error: {e}", file=sys.stderr)
+        return 2
+    if args.size: preset['resize_val'] = args.size
+    if args.encoder: preset['out_profile'] = args.encoder
+    if args.target_kb is not None: preset['out_target_kb'] = args.target_kb
+    if args.compositor: preset['out_compositor'] = args.compositor
+    if args.strip_memory_mb is not None: preset['out_strip_memory_mb'] = args.strip_memory_mb
+    if args.renditions: preset['out_renditions'] = args.renditions
+    if args.extra_formats: preset['out_extra_formats'] = args.extra_formats
+    naming_mode = preset.get('naming_mode', 'Keep Original')
+    prefix = preset.get('naming_prefix', '')
+
+    try:
+        pipeline = engine.Pipeline.from_preset(preset, FONT_DIR, enabled=not args.no_resize, mode=args.resize_mode,
+                                               output_fmt=args.format, quality=args.quality)
+    except ValueError as e:
+        print(f"Settings error: {e}", file=sys.stderr)
+        return 2
+    renditions, resize_cfg = pipeline.renditions, pipeline.config
+
+    files = collect_inputs(args.inputs, args.recursive)
+    if not files:
+        print("No input images found.", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+
+    # Індекс рахується по всьому відсортованому списку, тож імена стабільні між запусками
+    jobs, skipped, seen = [], 0, set()
+    for i, path in enumerate(files):
+        out_names = pipeline.filenames(path, naming_mode, prefix, i + 1)
+        taken = [name for name in out_names if name in seen]
+        if taken:
+            print(f"Skipping {path}: output name {taken[0]} already taken", file=sys.stderr)
+            skipped += 1
+            continue
+        seen.update(out_names)
+        out_paths = [os.path.join(args.output, name) for name in out_names]
+        if args.resume and all(os.path.exists(p) for p in out_paths):
+            skipped += 1
+            continue
+        jobs.append((path, out_paths if renditions else out_paths[0]))
+
+    total = len(jobs)
+    if not args.quiet:
+        print(f"{len(files)} inputs, {total} to process, {skipped} skipped; "
+              f"{args.workers} {args.backend} workers, {pipeline.output_fmt} q={pipeline.quality} ({resize_cfg['encoder_profile']})")
+
+    result_cache = engine.ResultCache(args.cache_dir, args.cache_size_mb * 2**20) if args.cache_dir else None
+    memory_budget = None
+    if args.memory_budget_mb != 0:
+        memory_budget = engine.MemoryBudget(args.memory_budget_mb * 2**20 if args.memory_budget_mb else None)
+    report, failed, source_sizes = [], [], {}
+    started = time.perf_counter()
+    batch = pipeline.run_many(jobs, args.workers, args.backend, args.profile,
+                              result_cache=result_cache, memory_budget=memory_budget)
+    for done, (src, stats, err) in enumerate(batch, 1):
+        if err is None:
+            for item in (stats if renditions else [stats]):
+                report.append(item)
+                source_sizes[src] = item['orig_size']
+                if not args.quiet:
+                    print(f"[{done:>{len(str(total))}}/{total}] {os.path.basename(src)} -> {item['filename']} "
+                          f"{item['orig_res']} -> {item['new_res']}, "
+                          f"{format_size(item['orig_size'])} -> {format_size(item['new_size'])}")
+        else:
+            failed.append((src, err))
+            print(f"[{done}/{total}] FAILED {src}: {err}", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    orig_total = sum(source_sizes.values())
+    new_total = sum(s['new_size'] for s in report)
+    print("--- Summary ---")
+    print(f"Processed: {len(source_sizes)}  Skipped: {skipped}  Failed: {len(failed)}"
+          + (f"  Outputs: {len(report)}" if renditions else ""))
+    if report:
+        saved = (1 - new_total / orig_total) * 100 if orig_total else 0.0
+        print(f"Size: {format_size(orig_total)} -> {format_size(new_total)} ({saved:.1f}% saved)")
+    print(f"Time: {elapsed:.1f}s ({len(report) / elapsed if elapsed else 0.0:.2f} img/s)")
+    if report:
+        print(f"Encode: {sum(s['encode_ms'] for s in report) / len(report):.1f} ms/img")
+    if memory_budget:
+        mem = memory_budget.summary()
+        print(f"Memory: budget {format_size(mem['budget'])}, peak estimate {format_size(mem['peak_bytes'])} "
+              f"({mem['peak_running']} at once), {mem['throttled']} held back, {mem['oversize']} ran alone")
+        if not args.quiet:
+            for event in memory_budget.events:
+                print(f"  {event['decision']:<9} {os.path.basename(event['file'])}: needs {format_size(event['estimate'])}, "
+                      f"{format_size(event['in_flight'])} in flight ({event['running']} running)"
+                      + (f", waited {event['waited_ms'] / 1000:.1f}s" if 'waited_ms' in event else ""))
+    if result_cache:
+        cache_stats = result_cache.stats()
+        print(f"Cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%}), "
+              f"{cache_stats['entries']} entries, {format_size(cache_stats['bytes'])}")
+    if resize_cfg['target_size_kb'] and report and 'target_met' in report[0]:
+        missed = [s['filename'] for s in report if not s['target_met']]
+        print(f"Target {resize_cfg['target_size_kb']} KB: mean quality "
+              f"{sum(s['quality'] for s in report) / len(report):.0f}, {len(missed)} over the limit")
+    if args.profile and report:
+        totals = {stage: sum(s['timings'][stage] for s in report) for stage in engine.STAGES}
+        grand = sum(totals.values()) or 1.0
+        print("Stages (total ms / mean ms / share):")
+        for stage, total_ms in totals.items():
+            print(f"  {stage:<15} {total_ms:>10.0f} {total_ms / len(report):>8.1f} {total_ms / grand * 100:>6.1f}%")
+        print(f"Decoded: {sum(s['decoded_pixels'] for s in report) / 1e6:.1f} MP, "
+              f"allocated: {format_size(sum(s['alloc_bytes'] for s in report))}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
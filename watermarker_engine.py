@@ -2,9 +2,25 @@ import io
 import os
 import re
 import base64  # NEW import
+import json
+import math
+import multiprocessing
+import hashlib
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+import concurrent.futures
+import functools
+import itertools
+from collections import OrderedDict, deque
 from datetime import datetime
-from PIL import Image, ImageEnhance, ImageOps, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageEnhance, ImageOps, ImageDraw, ImageFont, TiffImagePlugin, TiffTags
 from translitua import translit
+import watermarker_numpy
 
 """
 Watermarker Pro Engine v5.5 (Base64 Support)
@@ -24,6 +40,262 @@ DEFAULT_CONFIG = {
     'wm_position': 'bottom-right'
 }
 
+# Профілі енкодера: швидкість проти розміру файлу
+ENCODER_PROFILES = {
+    'fast': {
+        'JPEG': {'optimize': False, 'subsampling': 2, 'progressive': False},
+        'WEBP': {'method': 0},
+        'PNG': {'compress_level': 1},
+    },
+    'balanced': {
+        'JPEG': {'optimize': True, 'subsampling': 0, 'progressive': False},
+        'WEBP': {'method': 4},
+        'PNG': {'compress_level': 6},
+    },
+    'smallest': {
+        'JPEG': {'optimize': True, 'subsampling': 2, 'progressive': True},
+        'WEBP': {'method': 6},
+        'PNG': {'optimize': True, 'compress_level': 9},
+    },
+    # Налаштування до появи профілів: пресети без out_profile дають ті самі файли, що й раніше
+    'classic': {
+        'JPEG': {'optimize': True, 'subsampling': 0, 'progressive': False},
+        'WEBP': {'method': 6},
+        'PNG': {'optimize': True},
+    },
+}
+DEFAULT_ENCODER_PROFILE = 'classic'
+
+# Режим «цільовий розмір файлу»: межі пошуку якості для JPEG/WEBP
+TARGET_MIN_QUALITY = 10
+TARGET_MAX_ITERATIONS = 7
+
+# Скільки останніх очікувань у черзі спільного пулу враховувати в середньому
+POOL_WAIT_WINDOW = 200
+
+# Дисковий кеш результатів (ResultCache): межа розміру та версія формату ключа
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+RESULT_CACHE_VERSION = 2
+
+# Розмір блоку при потоковому збереженні завантажень
+INGEST_CHUNK_SIZE = 1024 * 1024
+
+# Допуск jobs за пам'яттю (MemoryBudget): частка доступної RAM і запасне значення
+MEMORY_BUDGET_SHARE = 0.6
+MEMORY_BUDGET_FALLBACK = 2 * 1024 ** 3
+# Постійні витрати job поза бітмапами (буфери декодера, результат у пам'яті)
+MEMORY_JOB_OVERHEAD = 8 * 1024 ** 2
+
+# Наскільки декодований (через JPEG draft) кадр має бути більшим за ціль
+DRAFT_REDUCING_GAP = 1.5
+
+# Джерела від цього розміру обробляються смугами: пам'ять обмежена STRIP_MEMORY_MB, а не площею кадру
+LARGE_IMAGE_PIXELS = 100_000_000
+STRIP_MEMORY_MB = 256
+# Захист Pillow від «декомпресійних бомб» відмовляє вже з ~179 МП, а скани й панорами більші.
+# Стандартний ліміт лишається для мініатюр, прев'ю та версій (вони декодують кадр цілком);
+# лише обробка зі смугами відкриває джерела до MAX_SOURCE_PIXELS.
+MAX_SOURCE_PIXELS = 1_000_000_000
+
+# Реалізації накладання лого: 'numpy' потребує NumPy, інакше рушій лишається на PIL
+COMPOSITORS = ("pil", "numpy")
+DEFAULT_COMPOSITOR = "pil"
+
+# Пресет-бандл: zip із settings.json та оригінальним файлом лого (без base64)
+PRESET_BUNDLE_EXT = ".wmpreset"
+PRESET_BUNDLE_VERSION = 1
+# Декодовані лого за хешем вмісту: rerun і прев'ю не декодують той самий файл знову
+LOGO_CACHE_SIZE = 8
+
+# Скільки підготовлених (масштабованих/повернутих) варіантів лого тримати в пам'яті
+WM_VARIANT_CACHE_SIZE = 64
+# Повнокадрові оверлеї замощення великі (4K RGBA ~ 33 МБ), тому їх небагато
+TILED_OVERLAY_CACHE_SIZE = 4
+# Зменшені копії для живого прев'ю
+PREVIEW_MAX_SIDE = 1280
+PREVIEW_PROXY_CACHE_SIZE = 16
+# Записи індексів мініатюр і хешів файлів малі, але без межі росли б усе життя сервера
+THUMB_INDEX_SIZE = 4096
+FILE_DIGEST_CACHE_SIZE = 4096
+
+class _LRUCache:
+    """Потокобезпечний LRU-кеш обмеженого розміру зі статистикою влучань."""
+    _MISSING = object()
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        value = self.get(key, self._MISSING)
+        if value is not self._MISSING: return value
+        # Будуємо поза локом: паралельні воркери не чекають один одного
+        value = factory()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+_WM_VARIANT_CACHE = _LRUCache(WM_VARIANT_CACHE_SIZE)
+_TILED_OVERLAY_CACHE = _LRUCache(TILED_OVERLAY_CACHE_SIZE)
+_PREVIEW_PROXY_CACHE = _LRUCache(PREVIEW_PROXY_CACHE_SIZE)
+_LOGO_CACHE = _LRUCache(LOGO_CACHE_SIZE)
+
+def get_cache_stats() -> dict:
+    """Статистика внутрішніх кешів рушія (для звітів і діагностики)."""
+    return {
+        "wm_variants": _WM_VARIANT_CACHE.stats(),
+        "tiled_overlays": _TILED_OVERLAY_CACHE.stats(),
+        "preview_proxies": _PREVIEW_PROXY_CACHE.stats(),
+        "logos": _LOGO_CACHE.stats(),
+        "thumbnails": _THUMB_INDEX.stats(),
+        "file_digests": _FILE_DIGESTS.stats()
+    }
+
+def clear_caches():
+    _WM_VARIANT_CACHE.clear()
+    _TILED_OVERLAY_CACHE.clear()
+    _PREVIEW_PROXY_CACHE.clear()
+    _LOGO_CACHE.clear()
+    _THUMB_INDEX.clear()
+    _FILE_DIGESTS.clear()
+
+# --- WORKER POOL ---
+# Пріоритети спільного пулу: інтерактивна робота (прев'ю, мініатюри) йде раніше за пакетну
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+_PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+class WorkerPool:
+    """
+    Один пул потоків на процес для всіх сесій веб-додатку. Загальна паралельність
+    обмежена max_workers (за замовчуванням — кількість ядер, але не менше двох). Черги
+    ведуться окремо для кожної сесії: воркер бере задачу найвищого пріоритету, а серед
+    сесій з однаковим пріоритетом — по колу, тож великий батч однієї сесії не блокує інших.
+    Пакетні задачі займають не більше max_workers - 1 воркерів: один завжди вільний
+    для прев'ю й мініатюр, інакше вони чекали б завершення вже запущеного job.
+    """
+
+    def __init__(self, max_workers: int = None):
+        # Навіть на одному ядрі потрібен другий воркер — резерв для інтерактивних задач
+        self.max_workers = max(2, max_workers or os.cpu_count() or 2)
+        self.bulk_limit = self.max_workers - 1
+        self.running = 0
+        self.running_bulk = 0
+        self.completed = 0
+        # priority -> {session: deque задач}; порядок сесій = черговість обслуговування
+        self._queues = {p: OrderedDict() for p in _PRIORITY_NAMES}
+        self._waits = {p: deque(maxlen=POOL_WAIT_WINDOW) for p in _PRIORITY_NAMES}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, fn, *args, session: str = "default", priority: int = PRIORITY_BULK, **kwargs) -> concurrent.futures.Future:
+        fut = concurrent.futures.Future()
+        with self._cond:
+            self._queues[priority].setdefault(session, deque()).append((fut, fn, args, kwargs, time.perf_counter()))
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, name=f"wm_pool_{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return fut
+
+    def _take(self):
+        for priority, sessions in self._queues.items():
+            if not sessions: continue
+            if priority == PRIORITY_BULK and self.running_bulk >= self.bulk_limit: continue
+            session, queue = next(iter(sessions.items()))
+            task = queue.popleft()
+            # Сесія переходить у кінець кола (або виходить з нього, якщо черга порожня)
+            del sessions[session]
+            if queue: sessions[session] = queue
+            return priority, task
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                taken = self._take()
+                while taken is None:
+                    self._cond.wait()
+                    taken = self._take()
+                priority, (fut, fn, args, kwargs, enqueued) = taken
+                fut.wait_ms = (time.perf_counter() - enqueued) * 1000
+                self._waits[priority].append(fut.wait_ms)
+                self.running += 1
+                if priority == PRIORITY_BULK: self.running_bulk += 1
+            # Скасовані (наприклад, перерваним батчем) задачі просто пропускаються
+            executed = fut.set_running_or_notify_cancel()
+            if executed:
+                try:
+                    fut.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    fut.set_exception(e)
+            with self._cond:
+                self.running -= 1
+                if priority == PRIORITY_BULK:
+                    self.running_bulk -= 1
+                    # Звільнене пакетне місце може взяти інший воркер, що чекає
+                    self._cond.notify()
+                if executed: self.completed += 1
+
+    def stats(self) -> dict:
+        """Глибина черг (загалом і за сесіями) та середнє очікування останніх задач, мс."""
+        with self._cond:
+            sessions = {}
+            result = {"workers": self.max_workers, "bulk_limit": self.bulk_limit, "running": self.running,
+                      "running_bulk": self.running_bulk, "completed": self.completed, "sessions": sessions}
+            for priority, name in _PRIORITY_NAMES.items():
+                result[f"queued_{name}"] = sum(len(q) for q in self._queues[priority].values())
+                waits = self._waits[priority]
+                result[f"wait_ms_{name}"] = sum(waits) / len(waits) if waits else 0.0
+                for session, queue in self._queues[priority].items():
+                    sessions[session] = sessions.get(session, 0) + len(queue)
+        return result
+
+_WORKER_POOL = None
+_WORKER_POOL_LOCK = threading.Lock()
+
+def get_worker_pool() -> WorkerPool:
+    """Спільний для процесу WorkerPool (створюється при першому зверненні)."""
+    global _WORKER_POOL
+    with _WORKER_POOL_LOCK:
+        if _WORKER_POOL is None: _WORKER_POOL = WorkerPool()
+        return _WORKER_POOL
+
 # --- NEW HELPERS FOR PRESETS ---
 def image_to_base64(image_bytes: bytes) -> str:
     """Конвертує байти зображення у рядок Base64 для збереження в JSON."""
@@ -33,64 +305,256 @@ def base64_to_bytes(base64_string: str) -> bytes:
     """Конвертує рядок Base64 назад у байти зображення."""
     return base64.b64decode(base64_string)
 
+def logo_digest(wm_bytes: bytes) -> str:
+    """Хеш вмісту файлу лого: ключ кешу декодованих лого і контроль цілісності бандла."""
+    return hashlib.sha256(wm_bytes).hexdigest()
+
+def dump_preset_bundle(settings: dict, wm_bytes: bytes = None) -> bytes:
+    """
+    Пакує налаштування в бандл: settings.json (компактний) і лого як є, без стиснення
+    (PNG уже стиснутий). Хеш лого записується в settings.json.
+    """
+    settings = {k: v for k, v in settings.items() if k not in ('wm_image_b64', 'wm_image_bytes', 'wm_image_hash')}
+    settings['bundle_version'] = PRESET_BUNDLE_VERSION
+    settings['wm_image'] = None
+    if wm_bytes:
+        try:
+            ext = _open_image(io.BytesIO(wm_bytes)).format.lower()
+        except Exception:
+            ext = "bin"
+        settings['wm_image'] = {'file': f"logo.{ext}", 'sha256': logo_digest(wm_bytes)}
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("settings.json", json.dumps(settings, ensure_ascii=False, separators=(',', ':')))
+        if wm_bytes: zf.writestr(settings['wm_image']['file'], wm_bytes, zipfile.ZIP_STORED)
+    return buf.getvalue()
+
+def parse_preset(data: bytes) -> dict:
+    """
+    Читає пресет: бандл (zip) або старий JSON з лого в base64.
+    Лого повертається байтами в 'wm_image_bytes' разом із хешем 'wm_image_hash'.
+    """
+    try:
+        if data[:4] == b"PK\x03\x04":
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                preset = json.loads(zf.read("settings.json"))
+                image = preset.pop('wm_image', None)
+                if image:
+                    wm_bytes = zf.read(image['file'])
+                    if logo_digest(wm_bytes) != image['sha256']: raise ValueError("logo hash mismatch")
+                    preset['wm_image_bytes'], preset['wm_image_hash'] = wm_bytes, image['sha256']
+            return preset
+        preset = json.loads(data)
+        if preset.get('wm_image_b64'):
+            wm_bytes = base64_to_bytes(preset.pop('wm_image_b64'))
+            preset['wm_image_bytes'], preset['wm_image_hash'] = wm_bytes, logo_digest(wm_bytes)
+        return preset
+    except (ValueError, KeyError, TypeError, zipfile.BadZipFile) as e:
+        raise ValueError(f"Invalid preset: {e}")
+
+def load_preset(path: str) -> dict:
+    """Читає пресет, збережений у веб-додатку (wm_preset_full.wmpreset або старий .json)."""
+    with open(path, "rb") as f:
+        return parse_preset(f.read())
+
+def watermark_from_preset(preset: dict, font_dir: str) -> Image.Image:
+    """Текст має пріоритет над логотипом — так само, як у веб-інтерфейсі."""
+    wm_text = preset.get('wm_text') or ''
+    if wm_text.strip():
+        font_name = preset.get('font_name')
+        font_path = os.path.join(font_dir, font_name) if font_name else None
+        return create_text_watermark(wm_text, font_path, 100, preset.get('wm_text_color', '#FFFFFF'))
+    if preset.get('wm_image_bytes'):
+        return load_watermark_cached(preset['wm_image_bytes'], preset.get('wm_image_hash'))
+    if preset.get('wm_image_b64'):
+        return load_watermark_cached(base64_to_bytes(preset['wm_image_b64']))
+    return None
+
+def resize_config_from_preset(preset: dict, enabled: bool = True, mode: str = "Max Side") -> dict:
+    """
+    Перетворює пресет на resize_config для process_image.
+    Режим ресайзу та прапорець enabled у пресеті не зберігаються, тому передаються окремо.
+    """
+    position = preset.get('wm_pos', DEFAULT_CONFIG['wm_position'])
+    return {
+        'enabled': enabled, 'mode': mode, 'value': preset.get('resize_val', 1920),
+        'wm_scale': preset.get('wm_scale', DEFAULT_CONFIG['wm_scale'] * 100) / 100,
+        'wm_margin': preset.get('wm_margin', DEFAULT_CONFIG['wm_margin']) if position != 'tiled' else 0,
+        'wm_gap': preset.get('wm_gap', DEFAULT_CONFIG['wm_gap']) if position == 'tiled' else 0,
+        'wm_position': position,
+        'wm_angle': preset.get('wm_angle', DEFAULT_CONFIG['wm_angle']),
+        'wm_opacity': preset.get('wm_opacity', DEFAULT_CONFIG['wm_opacity']),
+        'encoder_profile': preset.get('out_profile', DEFAULT_ENCODER_PROFILE),
+        'target_size_kb': preset.get('out_target_kb', 0),
+        'compositor': preset.get('out_compositor', DEFAULT_COMPOSITOR),
+        'strip_memory_mb': preset.get('out_strip_memory_mb', STRIP_MEMORY_MB)
+    }
+
 # --- STANDARD FUNCTIONS ---
-def generate_filename(original_path: str, naming_mode: str, prefix: str = "", extension: str = "jpg", index: int = 1) -> str:
+def generate_filename(original_path: str, naming_mode: str, prefix: str = "", extension: str = "jpg", index: int = 1,
+                      suffix: str = "") -> str:
     original_name = os.path.basename(original_path)
     clean_prefix = re.sub(r'[\s\W_]+', '-', translit(prefix).lower()).strip('-') if prefix else ""
+    # Суфікс версії (напр. "fhd") розрізняє кілька результатів з одного фото
+    tail = f"_{suffix}" if suffix else ""
     
     if naming_mode == "Prefix + Sequence":
         base_name = clean_prefix if clean_prefix else "image"
-        return f"{base_name}_{index:03d}.{extension}"
+        return f"{base_name}_{index:03d}{tail}.{extension}"
     
     name_only = os.path.splitext(original_name)[0]
     slug = re.sub(r'[\s\W_]+', '-', translit(name_only).lower()).strip('-')
     if not slug: slug = "image"
     
     base = f"{clean_prefix}_{slug}" if clean_prefix else slug
-    return f"{base}.{extension}"
+    return f"{base}{tail}.{extension}"
 
-def get_thumbnail(file_path: str, size=(300, 300)) -> str:
+# --- THUMBNAILS ---
+# (file_path, size) -> (mtime джерела, шлях до мініатюри)
+_THUMB_INDEX = _LRUCache(THUMB_INDEX_SIZE)
+_THUMB_PENDING = {}
+_THUMB_LOCK = threading.Lock()
+
+def _build_thumbnail(file_path: str, size: tuple, mtime: float) -> str:
     thumb_path = f"{file_path}.thumb.jpg"
-    if os.path.exists(thumb_path): return thumb_path
     try:
-        with Image.open(file_path) as img:
-            img = ImageOps.exif_transpose(img)
-            img = img.convert('RGB')
-            img.thumbnail(size)
-            img.save(thumb_path, "JPEG", quality=70)
-            return thumb_path
+        # Мініатюра з попереднього запуску ще актуальна, якщо не старша за джерело
+        if not (os.path.exists(thumb_path) and os.path.getmtime(thumb_path) >= mtime):
+            with _open_image(file_path) as img:
+                # Reduce-on-decode: JPEG декодується одразу в масштабі 1/2..1/8
+                if img.format == 'JPEG': img.draft('RGB', (size[0] * 2, size[1] * 2))
+                if _exif_orientation(img) != 1:
+                    img = ImageOps.exif_transpose(img)
+                img = img.convert('RGB')
+                img.thumbnail(size)
+                img.save(thumb_path + ".part", "JPEG", quality=70)
+            os.replace(thumb_path + ".part", thumb_path)
     except Exception as e:
         print(f"Thumb error: {e}")
         return None
+    with _THUMB_LOCK:
+        _THUMB_INDEX.put((file_path, size), (mtime, thumb_path))
+    return thumb_path
+
+def get_thumbnail(file_path: str, size=(300, 300)) -> str:
+    """
+    Шлях до мініатюри з індексу в пам'яті (без звернень до диска, крім stat джерела).
+    Якщо мініатюра вже генерується у фоні — чекає на неї, інакше будує синхронно.
+    """
+    size = tuple(size)
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
+        return None
+    with _THUMB_LOCK:
+        entry = _THUMB_INDEX.get((file_path, size))
+        pending = _THUMB_PENDING.get((file_path, size))
+    if entry and entry[0] == mtime: return entry[1]
+    if pending: return pending.result()
+    return _build_thumbnail(file_path, size, mtime)
+
+def prefetch_thumbnails(file_paths: list, size=(300, 300), session: str = "default"):
+    """
+    Запускає генерацію мініатюр у фоні (наприклад, одразу після завантаження)
+    через спільний пул з інтерактивним пріоритетом.
+    """
+    pool = get_worker_pool()
+    size = tuple(size)
+    for file_path in file_paths:
+        try:
+            mtime = os.path.getmtime(file_path)
+        except OSError:
+            continue
+        key = (file_path, size)
+        with _THUMB_LOCK:
+            entry = _THUMB_INDEX.get(key)
+            if (entry and entry[0] == mtime) or key in _THUMB_PENDING: continue
+            fut = pool.submit(_build_thumbnail, file_path, size, mtime, session=session, priority=PRIORITY_INTERACTIVE)
+            _THUMB_PENDING[key] = fut
+        fut.add_done_callback(lambda _f, key=key: _forget_pending_thumb(key))
+
+def _forget_pending_thumb(key: tuple):
+    with _THUMB_LOCK:
+        _THUMB_PENDING.pop(key, None)
 
 def load_watermark_from_file(wm_file_bytes: bytes) -> Image.Image:
     if not wm_file_bytes: return None
     try:
-        wm = Image.open(io.BytesIO(wm_file_bytes)).convert("RGBA")
+        wm = _open_image(io.BytesIO(wm_file_bytes)).convert("RGBA")
         return wm
     except Exception as e:
         raise ValueError(f"Failed to load logo: {str(e)}")
 
-def create_text_watermark(text: str, font_path: str, size_pt: int, color_hex: str) -> Image.Image:
-    if not text: return None
+def load_watermark_cached(wm_file_bytes: bytes, digest: str = None) -> Image.Image:
+    """
+    Як load_watermark_from_file, але декодоване лого кешується за хешем вмісту,
+    а хеш стає токеном знака — готові варіанти (масштаб, прозорість, кут) теж не перебудовуються.
+    Якщо хеш уже відомий (з бандла), байти не хешуються повторно. Результат не змінювати.
+    """
+    if not wm_file_bytes: return None
+    digest = digest or logo_digest(wm_file_bytes)
+
+    def build():
+        wm = load_watermark_from_file(wm_file_bytes)
+        wm.info['wm_token'] = f"logo:{digest}"
+        return wm
+
+    return _LOGO_CACHE.get_or_create(digest, build)
+
+# Відступ навколо тексту при базовому розмірі шрифту; масштабується разом із ним
+TEXT_PADDING = 10
+
+@functools.lru_cache(maxsize=64)
+def _load_font(font_path: str, size: int):
+    """Шрифт за шляхом і розміром (кешується; змінні TTF, як Roboto, — з типовими осями)."""
+    if font_path:
+        try:
+            return ImageFont.truetype(font_path, size)
+        except Exception:
+            pass  # Шрифту з пресету немає на цій машині — вбудований, але того ж розміру
     try:
-        font = ImageFont.truetype(font_path, size_pt) if font_path else ImageFont.load_default()
-    except:
-        font = ImageFont.load_default()
-        
+        return ImageFont.load_default(size)
+    except Exception:
+        return ImageFont.load_default()
+
+def _render_text(text: str, font, rgb: tuple, padding: int) -> Image.Image:
     dummy_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
     bbox = dummy_draw.textbbox((0, 0), text, font=font)
     w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
-    
-    wm = Image.new('RGBA', (w + 20, h + 20), (0, 0, 0, 0))
+
+    wm = Image.new('RGBA', (w + 2 * padding, h + 2 * padding), (0, 0, 0, 0))
     draw = ImageDraw.Draw(wm)
-    
+    # Зсув на початок bbox, щоб верхні відступи гліфів і виносні елементи не обрізались
+    draw.text((padding - bbox[0], padding - bbox[1]), text, font=font, fill=rgb + (255,))
+    return wm
+
+@functools.lru_cache(maxsize=16)
+def create_text_watermark(text: str, font_path: str, size_pt: int, color_hex: str) -> Image.Image:
+    """
+    Текстовий знак при size_pt (для прев'ю та розрахунку пропорцій). Параметри тексту
+    зберігаються в info['wm_text'], і рушій перемальовує гліфи одразу в потрібному
+    розмірі замість масштабування цього bitmap. Результат кешується — не змінюйте його.
+    """
+    if not text: return None
     color = color_hex.lstrip('#')
     rgb = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
-    
-    draw.text((10, 10), text, font=font, fill=rgb + (255,))
+
+    wm = _render_text(text, _load_font(font_path, size_pt), rgb, TEXT_PADDING)
+    spec = (text, font_path, size_pt, rgb)
+    wm.info['wm_text'] = spec
+    wm.info['wm_token'] = "text:" + hashlib.blake2b(repr(spec).encode(), digest_size=16).hexdigest()
     return wm
 
+def _render_text_variant(wm_obj: Image.Image, wm_w_target: int, wm_h_target: int) -> Image.Image:
+    """Текстовий знак, намальований шрифтом потрібного розміру (ширина — з точністю до гліфа)."""
+    text, font_path, size_pt, rgb = wm_obj.info['wm_text']
+    ratio = wm_w_target / float(wm_obj.width)
+    font = _load_font(font_path, max(1, round(size_pt * ratio)))
+    # Растровий шрифт без FreeType не масштабується — лишається LANCZOS
+    if not isinstance(font, ImageFont.FreeTypeFont):
+        return wm_obj.resize((wm_w_target, wm_h_target), Image.Resampling.LANCZOS)
+    return _render_text(text, font, rgb, round(TEXT_PADDING * ratio))
+
 def apply_opacity(image: Image.Image, opacity: float) -> Image.Image:
     if opacity >= 1.0: return image
     alpha = image.split()[3]
@@ -98,127 +562,1700 @@ def apply_opacity(image: Image.Image, opacity: float) -> Image.Image:
     image.putalpha(alpha)
     return image
 
-def process_image(file_path: str, filename: str, wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int) -> tuple:
-    with Image.open(file_path) as img:
-        img = ImageOps.exif_transpose(img)
-        exif_data = img.info.get('exif')
-        
-        orig_w, orig_h = img.size
-        orig_size = os.path.getsize(file_path)
-        img = img.convert("RGBA")
-        
-        # Resize
-        target_value = resize_config.get('value', 1920)
-        mode = resize_config.get('mode', 'Max Side')
-        enabled = resize_config.get('enabled', False)
-        
-        new_w, new_h = orig_w, orig_h
-        scale_factor = 1.0
-
-        if enabled:
-            if mode == "Max Side" and (orig_w > target_value or orig_h > target_value):
-                if orig_w >= orig_h:
-                    scale_factor = target_value / float(orig_w)
-                    new_w, new_h = target_value, int(float(orig_h) * scale_factor)
-                else:
-                    scale_factor = target_value / float(orig_h)
-                    new_w, new_h = int(float(orig_w) * scale_factor), target_value
-            elif mode == "Exact Width":
+def _exif_orientation(img: Image.Image) -> int:
+    # Pillow шукає eXIf після IDAT повним декодуванням PNG; за специфікацією він іде до IDAT
+    if img.format == 'PNG' and 'exif' not in img.info: return 1
+    try:
+        return img.getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+
+def _oriented_size(img: Image.Image) -> tuple:
+    """Розмір зображення після exif_transpose, прочитаний лише із заголовка."""
+    w, h = img.size
+    if _exif_orientation(img) in (5, 6, 7, 8): return h, w
+    return w, h
+
+# Етапи process_image у порядку виконання (ключі stats['timings'])
+STAGES = ("open", "decode", "exif_transpose", "convert", "resize",
+          "wm_prepare", "composite", "flatten", "encode")
+
+class _StageTimer:
+    """Заміри тривалості етапів і об'єму бітмапів; вимкнений таймер нічого не робить."""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.timings = {}
+        self.alloc_bytes = 0
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str):
+        if not self.enabled: return
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+    def alloc(self, img: Image.Image):
+        if self.enabled: self.alloc_bytes += img.width * img.height * len(img.getbands())
+
+def _target_size(orig_w: int, orig_h: int, resize_config: dict) -> tuple:
+    target_value = resize_config.get('value', 1920)
+    mode = resize_config.get('mode', 'Max Side')
+    enabled = resize_config.get('enabled', False)
+    
+    new_w, new_h = orig_w, orig_h
+    scale_factor = 1.0
+
+    if enabled:
+        if mode == "Max Side" and (orig_w > target_value or orig_h > target_value):
+            if orig_w >= orig_h:
                 scale_factor = target_value / float(orig_w)
                 new_w, new_h = target_value, int(float(orig_h) * scale_factor)
-            elif mode == "Exact Height":
+            else:
                 scale_factor = target_value / float(orig_h)
                 new_w, new_h = int(float(orig_w) * scale_factor), target_value
+        elif mode == "Exact Width":
+            scale_factor = target_value / float(orig_w)
+            new_w, new_h = target_value, int(float(orig_h) * scale_factor)
+        elif mode == "Exact Height":
+            scale_factor = target_value / float(orig_h)
+            new_w, new_h = int(float(orig_w) * scale_factor), target_value
+    return new_w, new_h, scale_factor
+
+def _reduce_on_decode(img: Image.Image, oriented_size: tuple, new_size: tuple):
+    """
+    Для JPEG просить декодер одразу масштабувати DCT (1/2, 1/4, 1/8).
+    Декодований кадр лишається щонайменше в DRAFT_REDUCING_GAP разів більшим
+    за ціль, тож фінальний LANCZOS працює як і раніше, але на меншому бітмапі.
+    """
+    if img.format != 'JPEG': return
+    new_w, new_h = new_size
+    if oriented_size != img.size: new_w, new_h = new_h, new_w
+    req_w = int(new_w * DRAFT_REDUCING_GAP)
+    req_h = int(new_h * DRAFT_REDUCING_GAP)
+    if req_w >= img.width or req_h >= img.height: return
+    img.draft(None, (req_w, req_h))
+
+def _watermark_token(wm_obj: Image.Image) -> str:
+    """
+    Стабільний ідентифікатор вмісту лого. Рахується один раз і зберігається
+    в wm_obj.info, тому однакові лого з різних перезапусків діляться кешем.
+    """
+    token = wm_obj.info.get('wm_token')
+    if token is None:
+        digest = hashlib.blake2b(wm_obj.tobytes(), digest_size=16).hexdigest()
+        token = f"{wm_obj.mode}:{wm_obj.width}x{wm_obj.height}:{digest}"
+        wm_obj.info['wm_token'] = token
+    return token
+
+def _prepare_watermark(wm_obj: Image.Image, wm_w_target: int, angle: float, opacity: float) -> tuple:
+    """
+    Масштабоване, напівпрозоре та повернуте лого зі спільного LRU-кешу.
+    Текстовий знак не масштабується, а малюється в цільовому розмірі.
+    Повертає (ключ варіанта, зображення); ключ далі використовує кеш оверлеїв.
+    """
+    w_ratio = wm_w_target / float(wm_obj.width)
+    wm_h_target = int(float(wm_obj.height) * w_ratio)
+    if wm_h_target < 1: wm_h_target = 1
+
+    def build():
+        if 'wm_text' in wm_obj.info:
+            wm = _render_text_variant(wm_obj, wm_w_target, wm_h_target)
+        else:
+            wm = wm_obj.resize((wm_w_target, wm_h_target), Image.Resampling.LANCZOS)
+        wm = apply_opacity(wm, opacity)
+        if angle != 0:
+            wm = wm.rotate(angle, expand=True, resample=Image.BICUBIC)
+        return wm
+
+    key = (_watermark_token(wm_obj), wm_w_target, angle, round(opacity, 3))
+    return key, _WM_VARIANT_CACHE.get_or_create(key, build)
+
+def _tile_fill(cell: Image.Image, size: tuple) -> Image.Image:
+    """
+    Заповнює кадр копіями клітинки подвоєнням уже заповненої області:
+    log2(кадр/клітинка) операцій paste замість однієї на кожну плитку.
+    """
+    w, h = size
+    cell_w, cell_h = cell.size
+    strip = Image.new('RGBA', (w, cell_h), (0, 0, 0, 0))
+    strip.paste(cell, (0, 0))
+    filled = cell_w
+    while filled < w:
+        strip.paste(strip.crop((0, 0, filled, cell_h)), (filled, 0))
+        filled *= 2
+
+    overlay = Image.new('RGBA', (w, h), (0, 0, 0, 0))
+    overlay.paste(strip, (0, 0))
+    filled = cell_h
+    while filled < h:
+        overlay.paste(overlay.crop((0, 0, w, filled)), (0, filled))
+        filled *= 2
+    return overlay
+
+def _build_tile_cell(wm: Image.Image, gap: int) -> Image.Image:
+    wm_w, wm_h = wm.size
+    step_x = wm_w + gap
+    step_y = wm_h + gap
+    if step_x < 10: step_x = 10
+    if step_y < 10: step_y = 10
+
+    # Кожен наступний ряд зсунутий на пів кроку, тож візерунок повторюється
+    # з періодом step_x по горизонталі та два ряди по вертикалі.
+    cell_w, cell_h = step_x, 2 * step_y
+    cell = Image.new('RGBA', (cell_w, cell_h), (0, 0, 0, 0))
+    for x, y in ((0, 0), (step_x // 2, step_y)):
+        for dx in (0, -cell_w):
+            for dy in (0, -cell_h):
+                cell.paste(wm, (x + dx, y + dy), wm)
+    return cell
+
+def _get_tiled_overlay(variant_key: tuple, wm: Image.Image, size: tuple, gap: int) -> Image.Image:
+    key = (size, variant_key, gap)
+    return _TILED_OVERLAY_CACHE.get_or_create(key, lambda: _tile_fill(_build_tile_cell(wm, gap), size))
+
+def _has_alpha(img: Image.Image) -> bool:
+    if img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La'): return True
+    return 'transparency' in img.info
+
+def _blend(img: Image.Image, layer: Image.Image, pos: tuple):
+    """Накладає RGBA-шар лише на ту область кадру, яку він покриває."""
+    if img.mode == 'RGBA':
+        img.alpha_composite(layer, dest=pos)
+    else:
+        img.paste(layer, pos, layer)
+
+def encoder_kwargs(output_fmt: str, quality: int, profile: str = DEFAULT_ENCODER_PROFILE) -> dict:
+    """Аргументи Image.save() для формату та профілю енкодера."""
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile: {profile}")
+    kwargs = {"format": output_fmt}
+    if output_fmt in ("JPEG", "WEBP"): kwargs["quality"] = quality
+    kwargs.update(ENCODER_PROFILES[profile].get(output_fmt, {}))
+    return kwargs
+
+# Буфер кодування на потік: при пошуку якості не виділяємо новий на кожну спробу
+_ENCODE_BUFFERS = threading.local()
+
+def _encode_buffer() -> io.BytesIO:
+    buf = getattr(_ENCODE_BUFFERS, 'buf', None)
+    if buf is None:
+        buf = _ENCODE_BUFFERS.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    return buf
+
+def _encode_to_target(img: Image.Image, save_kwargs: dict, max_bytes: int) -> tuple:
+    """
+    Двійковий пошук найвищої якості, за якої файл вкладається в max_bytes.
+    Кодує той самий вже підготовлений кадр, не більше TARGET_MAX_ITERATIONS разів.
+    Повертає (байти, якість, кількість спроб, чи вкладено в ліміт).
+    """
+    def encode(q):
+        buf = _encode_buffer()
+        img.save(buf, **dict(save_kwargs, quality=q))
+        return buf
+
+    # Задана якість — верхня межа; часто вона вже вкладається в ліміт
+    hi = save_kwargs['quality']
+    buf = encode(hi)
+    iterations = 1
+    if buf.tell() <= max_bytes: return buf.getvalue(), hi, iterations, True
+
+    lo, hi = TARGET_MIN_QUALITY, hi - 1
+    best = None
+    # Найменший із закодованих варіантів — на випадок, якщо ліміт недосяжний
+    smallest = (buf.tell(), buf.getvalue(), save_kwargs['quality'])
+    while lo <= hi and iterations < TARGET_MAX_ITERATIONS:
+        mid = (lo + hi) // 2
+        buf = encode(mid)
+        iterations += 1
+        if buf.tell() <= max_bytes:
+            best = (buf.getvalue(), mid)
+            lo = mid + 1
+        else:
+            hi = mid - 1
+            if buf.tell() < smallest[0]: smallest = (buf.tell(), buf.getvalue(), mid)
+    if best: return best[0], best[1], iterations, True
+
+    # Ліміт недосяжний: найменший можливий файл, якщо мінімальну якість ще не пробували і бюджет дозволяє
+    if smallest[2] != TARGET_MIN_QUALITY and iterations < TARGET_MAX_ITERATIONS:
+        buf = encode(TARGET_MIN_QUALITY)
+        iterations += 1
+        if buf.tell() < smallest[0]: smallest = (buf.tell(), buf.getvalue(), TARGET_MIN_QUALITY)
+    return smallest[1], smallest[2], iterations, False
+
+def _numpy_compositor(resize_config: dict):
+    """Модуль NumPy-ядер, якщо його обрано в конфігу і NumPy встановлено; інакше None (шлях PIL)."""
+    if resize_config.get('compositor', DEFAULT_COMPOSITOR) == 'numpy' and watermarker_numpy.AVAILABLE:
+        return watermarker_numpy
+    return None
+
+def _watermark_layer(size: tuple, wm_obj: Image.Image, resize_config: dict, px_scale: float,
+                     opacity: float) -> tuple:
+    """
+    Геометрія знака для кадру size: (ключ варіанта, лого, позиція, проміжок).
+    Для замощення позиція None — оверлей будується з лого та проміжку.
+    """
+    new_w, new_h = size
+    scale = resize_config.get('wm_scale', DEFAULT_CONFIG['wm_scale'])
+    position = resize_config.get('wm_position', DEFAULT_CONFIG['wm_position'])
+    angle = resize_config.get('wm_angle', DEFAULT_CONFIG['wm_angle'])
+    
+    if scale > 0.9: scale = 0.9
+    
+    wm_w_target = int(new_w * scale)
+    if wm_w_target < 10: wm_w_target = 10
+    
+    variant_key, wm_resized = _prepare_watermark(wm_obj, wm_w_target, angle, opacity)
+    wm_w_final, wm_h_final = wm_resized.size
+
+    if position == 'tiled':
+        gap = int(resize_config.get('wm_gap', DEFAULT_CONFIG['wm_gap']) * px_scale)
+        return variant_key, wm_resized, None, gap
+
+    margin = int(resize_config.get('wm_margin', DEFAULT_CONFIG['wm_margin']) * px_scale)
+    pos_x, pos_y = 0, 0
+    if position == 'bottom-right': 
+        pos_x, pos_y = new_w - wm_w_final - margin, new_h - wm_h_final - margin
+    elif position == 'bottom-left': 
+        pos_x, pos_y = margin, new_h - wm_h_final - margin
+    elif position == 'top-right': 
+        pos_x, pos_y = new_w - wm_w_final - margin, margin
+    elif position == 'top-left': 
+        pos_x, pos_y = margin, margin
+    elif position == 'center': 
+        pos_x, pos_y = (new_w - wm_w_final) // 2, (new_h - wm_h_final) // 2
+    
+    pos_x = max(0, min(pos_x, new_w - wm_w_final))
+    pos_y = max(0, min(pos_y, new_h - wm_h_final))
+    return variant_key, wm_resized, (pos_x, pos_y), 0
+
+def _layer_opacities(resize_config: dict, kernels) -> tuple:
+    """
+    (прозорість у варіанті лого, прозорість при змішуванні). PIL запікає її у варіант.
+    NumPy застосовує її при змішуванні, крім замощення: клітинка будується paste з маскою
+    (альфа підноситься до квадрата вже після прозорості), тож і NumPy бере запечений варіант.
+    """
+    opacity = resize_config.get('wm_opacity', DEFAULT_CONFIG['wm_opacity'])
+    if not kernels: return opacity, opacity
+    if resize_config.get('wm_position', DEFAULT_CONFIG['wm_position']) == 'tiled': return opacity, 1.0
+    return 1.0, opacity
+
+def _composite(img: Image.Image, layer: Image.Image, pos: tuple, opacity: float, kernels, flatten: bool) -> Image.Image:
+    if kernels: return kernels.composite(img, layer, pos, opacity, flatten=flatten)
+    _blend(img, layer, pos)
+    return img
+
+def _apply_watermark(img: Image.Image, wm_obj: Image.Image, resize_config: dict, px_scale: float = 1.0,
+                     timer: _StageTimer = None, flatten: bool = False) -> Image.Image:
+    """
+    Накладає лого на кадр і повертає кадр. px_scale < 1 — для прев'ю зі зменшеної копії:
+    відступи та проміжки (задані в пікселях фінального кадру) масштабуються разом із кадром.
+
+    Шлях PIL змінює кадр на місці. З compositor='numpy' прозорість лого застосовується
+    під час змішування (варіанти лого й оверлеї кешуються без неї), а flatten=True
+    одразу зводить прозорий кадр на білий фон — тоді повертається новий RGB-кадр.
+    """
+    kernels = _numpy_compositor(resize_config)
+    variant_opacity, opacity = _layer_opacities(resize_config, kernels)
+    variant_key, layer, pos, gap = _watermark_layer(img.size, wm_obj, resize_config, px_scale, variant_opacity)
+    if pos is None:
+        layer, pos = _get_tiled_overlay(variant_key, layer, img.size, gap), (0, 0)
+    if timer: timer.lap("wm_prepare")
+    return _composite(img, layer, pos, opacity, kernels, flatten)
+
+def _decode_source(img: Image.Image, oriented_size: tuple, new_size: tuple, timer: _StageTimer) -> tuple:
+    """
+    Декодує відкрите джерело (з draft під new_size), повертає його за EXIF і
+    зводить до робочого режиму. Повертає (кадр, exif, work_mode, декодовано пікселів).
+    """
+    if new_size[0] < oriented_size[0] or new_size[1] < oriented_size[1]:
+        _reduce_on_decode(img, oriented_size, new_size)
+    img.load()
+    decoded_pixels = img.width * img.height
+    timer.alloc(img)
+    timer.lap("decode")
+
+    # exif_transpose копіює кадр навіть без повороту, тому викликаємо лише за потреби
+    if _exif_orientation(img) != 1:
+        img = ImageOps.exif_transpose(img)
+        timer.alloc(img)
+    exif_data = img.info.get('exif')
+    timer.lap("exif_transpose")
+
+    # RGBA лише тоді, коли джерело справді має прозорість. Колірний ключ (tRNS) стає альфою
+    # до ресайзу: після LANCZOS змішані пікселі вже не збігаються з ключем
+    work_mode = "RGBA" if _has_alpha(img) else "RGB"
+    if img.mode not in ("L", "LA", "RGB", "RGBA") or 'transparency' in img.info:
+        img = img.convert(work_mode)
+        timer.alloc(img)
+    timer.lap("convert")
+    return img, exif_data, work_mode, decoded_pixels
+
+def _resize_frame(img: Image.Image, new_size: tuple, work_mode: str, timer: _StageTimer) -> Image.Image:
+    if img.size != new_size:
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+        timer.alloc(img)
+    timer.lap("resize")
+    if img.mode != work_mode:
+        img = img.convert(work_mode)
+        timer.alloc(img)
+    if work_mode == "RGBA" and img.getchannel("A").getextrema()[0] == 255:
+        img = img.convert("RGB")
+        timer.alloc(img)
+    timer.lap("convert")
+    return img
+
+def _finish_frame(img: Image.Image, wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int,
+                  exif_data: bytes, timer: _StageTimer) -> tuple:
+    """Знак, зведення прозорості та кодування. Змінює img на місці; повертає (байти, stats кодування)."""
+    if wm_obj:
+        img = _apply_watermark(img, wm_obj, resize_config, timer=timer, flatten=output_fmt in ("JPEG", "RGB"))
+        timer.lap("composite")
+
+    if output_fmt in ("JPEG", "RGB") and img.mode == "RGBA":
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+        timer.alloc(img)
+    timer.lap("flatten")
+    return _encode_frame(img, resize_config, output_fmt, quality, exif_data, timer)
+
+def _encode_frame(img: Image.Image, resize_config: dict, output_fmt: str, quality: int, exif_data: bytes,
+                  timer: _StageTimer) -> tuple:
+    save_kwargs = encoder_kwargs(output_fmt, quality, resize_config.get('encoder_profile', DEFAULT_ENCODER_PROFILE))
+    if exif_data: save_kwargs['exif'] = exif_data
+    target_kb = resize_config.get('target_size_kb') or 0
+
+    encode_started = time.perf_counter()
+    encode_stats = {}
+    if target_kb > 0 and 'quality' in save_kwargs:
+        result_bytes, quality, iterations, target_met = _encode_to_target(img, save_kwargs, int(target_kb * 1024))
+        encode_stats = {"target_size_kb": target_kb, "target_met": target_met, "quality_iterations": iterations}
+    else:
+        output_buffer = _encode_buffer()
+        img.save(output_buffer, **save_kwargs)
+        result_bytes = output_buffer.getvalue()
+    encode_stats["encode_ms"] = (time.perf_counter() - encode_started) * 1000
+    encode_stats["quality"] = quality if 'quality' in save_kwargs else None
+    timer.lap("encode")
+    return result_bytes, encode_stats
+
+def _frame_stats(filename: str, orig_res: tuple, new_res: tuple, orig_size: int, result_size: int,
+                 scale_factor: float, encode_stats: dict, timer: _StageTimer, decoded_pixels: int) -> dict:
+    stats = {
+        "filename": filename,
+        "orig_res": f"{orig_res[0]}x{orig_res[1]}",
+        "new_res": f"{new_res[0]}x{new_res[1]}",
+        "orig_size": orig_size,
+        "new_size": result_size,
+        "scale_factor": f"{scale_factor:.2f}x",
+        "encode_ms": encode_stats.pop("encode_ms"),
+        "quality": encode_stats.pop("quality")
+    }
+    stats.update(encode_stats)
+    if timer.enabled:
+        stats['timings'] = {stage: timer.timings.get(stage, 0.0) for stage in STAGES}
+        stats['decoded_pixels'] = decoded_pixels
+        stats['alloc_bytes'] = timer.alloc_bytes
+    return stats
+
+def process_image(file_path: str, filename: str, wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int,
+                  profile: bool = False) -> tuple:
+    """
+    profile=True додає в stats тривалість кожного етапу (stats['timings'], мс),
+    кількість декодованих пікселів і приблизний об'єм виділених бітмапів.
+    Налаштування не перевіряються; Pipeline перевіряє їх один раз для всього пакета.
+    """
+    return _process_image(file_path, filename, wm_obj, resize_config, output_fmt, quality, profile)
+
+def _process_image(file_path: str, filename: str, wm_obj: Image.Image, resize_config: dict, output_fmt: str,
+                   quality: int, profile: bool = False, out_file=None) -> tuple:
+    """
+    Як process_image. З out_file великий PNG пишеться у файл смугами, і замість байтів
+    повертається None.
+    """
+    timer = _StageTimer(profile)
+    with _open_source(file_path, resize_config) as img:
+        orig_w, orig_h = _oriented_size(img)
+        orig_size = os.path.getsize(file_path)
+        new_w, new_h, scale_factor = _target_size(orig_w, orig_h, resize_config)
+        timer.lap("open")
+
+        if _use_strips(img, resize_config):
+            result_bytes, encode_stats, decoded_pixels = _process_strips(
+                img, (new_w, new_h), wm_obj, resize_config, output_fmt, quality, timer, out_file)
+        else:
+            img, exif_data, work_mode, decoded_pixels = _decode_source(img, (orig_w, orig_h), (new_w, new_h), timer)
+            img = _resize_frame(img, (new_w, new_h), work_mode, timer)
+            result_bytes, encode_stats = _finish_frame(img, wm_obj, resize_config, output_fmt, quality, exif_data, timer)
+        result_size = len(result_bytes) if result_bytes is not None else out_file.tell()
+        stats = _frame_stats(filename, (orig_w, orig_h), (new_w, new_h), orig_size, result_size,
+                             scale_factor, encode_stats, timer, decoded_pixels)
+        return result_bytes, stats
+
+def _write_atomic(out_path: str, data: bytes):
+    tmp_path = out_path + ".part"
+    with open(tmp_path, "wb") as f: f.write(data)
+    os.replace(tmp_path, out_path)
+
+def process_image_to_file(file_path: str, out_path: str, wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int,
+                          profile: bool = False) -> dict:
+    """
+    Обробляє файл і записує результат на диск; повертає лише stats.
+    Запис атомарний (через .part), тож наявний out_path завжди є завершеним файлом.
+    """
+    started = time.perf_counter()
+    tmp_path = out_path + ".part"
+    try:
+        with open(tmp_path, "wb") as f:
+            result_bytes, stats = _process_image(file_path, os.path.basename(out_path), wm_obj, resize_config,
+                                                 output_fmt, quality, profile, out_file=f)
+            if result_bytes is not None: f.write(result_bytes)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    stats['output_path'] = out_path
+    stats['elapsed_ms'] = (time.perf_counter() - started) * 1000
+    return stats
+
+# --- LARGE IMAGES (STRIPS) ---
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return b"".join(_png_chunk_parts(tag, [data]))
 
-            if scale_factor != 1.0:
-                img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+def _png_chunk_parts(tag: bytes, parts: list) -> list:
+    """Чанк PNG зі списку шматків даних без їх попереднього склеювання."""
+    crc = zlib.crc32(tag)
+    for part in parts: crc = zlib.crc32(part, crc)
+    return [struct.pack(">I", sum(len(part) for part in parts)) + tag, *parts, struct.pack(">I", crc)]
 
-        # Watermark
+class _PngRowReader:
+    """
+    Потокове декодування 8-бітного неінтерльованого PNG смугами. IDAT розпаковується
+    частинами, а кожна смуга декодується Pillow як окремий маленький PNG: на початку
+    в ньому йдуть уже декодовані рядки перекриття з попередньою смугою (фільтр None),
+    тож фільтри Up/Average/Paeth першого нового рядка бачать правильного сусіда.
+    Запити мають іти згори донизу й перекриватися не більше ніж на overlap рядків.
+    """
+
+    def __init__(self, file_path: str, overlap: int = 0):
+        self._f = open(file_path, "rb")
+        self._overlap = overlap + 1
+        try:
+            self._read_header()
+        except Exception:
+            self._f.close()
+            raise
+
+    def _read_header(self):
+        if self._f.read(8) != _PNG_SIGNATURE: raise ValueError("Not a PNG file")
+        self._extra = []
+        while True:
+            length, tag = struct.unpack(">I4s", self._f.read(8))
+            if tag == b"IDAT": break
+            data = self._f.read(length)
+            self._f.read(4)
+            if tag == b"IHDR": self._ihdr = data
+            elif tag in (b"PLTE", b"tRNS"): self._extra.append(_png_chunk(tag, data))
+        width, height, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", self._ihdr)
+        if depth != 8 or interlace or color_type not in _PNG_CHANNELS:
+            raise ValueError("Only 8-bit non-interlaced PNG can be streamed")
+        self.size = (width, height)
+        self._idat_left = length
+        self._stride = width * _PNG_CHANNELS[color_type]
+        self._inflate = zlib.decompressobj()
+        # Декодовані рядки [_tail_y, _y) з байтом фільтра None; рядок -1 — нульовий, як у специфікації
+        self._y, self._tail_y = 0, -1
+        self._tail = bytes(self._stride + 1)
+
+    @staticmethod
+    def open(img: Image.Image, file_path: str, overlap: int = 0):
+        """Читач для img, якщо його можна декодувати смугами (PNG без повороту за EXIF); інакше None."""
+        if img.format != 'PNG' or _exif_orientation(img) != 1: return None
+        try:
+            return _PngRowReader(file_path, overlap)
+        except (ValueError, struct.error):
+            return None
+
+    def close(self):
+        self._f.close()
+
+    def _filtered_rows(self, count: int) -> bytes:
+        need = count * (self._stride + 1)
+        parts, have = [], 0
+        while have < need:
+            data = self._inflate.unconsumed_tail
+            if not data:
+                if not self._idat_left:
+                    self._f.read(4)
+                    length, tag = struct.unpack(">I4s", self._f.read(8))
+                    if tag != b"IDAT": raise ValueError("Truncated PNG image data")
+                    self._idat_left = length
+                    continue
+                data = self._f.read(min(self._idat_left, INGEST_CHUNK_SIZE))
+                if not data: raise ValueError("Truncated PNG image data")
+                self._idat_left -= len(data)
+            # Обмеження виходу: стиснутий шматок не розгортається більше, ніж треба смузі
+            chunk = self._inflate.decompress(data, need - have)
+            parts.append(chunk)
+            have += len(chunk)
+        return b"".join(parts)
+
+    def _decode(self, first: int, y1: int) -> Image.Image:
+        """Рядки [first, y1): first — у межах хвоста вже декодованих рядків."""
+        row_bytes = self._stride + 1
+        context = self._tail[(first - self._tail_y) * row_bytes:]
+        rows = self._filtered_rows(y1 - self._y) if y1 > self._y else b""
+        deflate = zlib.compressobj(0)
+        idat = [deflate.compress(context), deflate.compress(rows), deflate.flush()]
+        del rows
+        height = max(y1, self._y) - first
+        ihdr = struct.pack(">II", self.size[0], height) + self._ihdr[8:]
+        png = b"".join([_PNG_SIGNATURE, _png_chunk(b"IHDR", ihdr), *self._extra,
+                        *_png_chunk_parts(b"IDAT", idat), _png_chunk(b"IEND", b"")])
+        del idat
+        with Image.open(io.BytesIO(png)) as band:
+            band.load()
+        del png
+
+        # Хвіст для наступної смуги
+        keep = min(self._overlap, height)
+        raw = band.crop((0, height - keep, self.size[0], height)).tobytes()
+        self._tail = b"".join(b"\x00" + raw[i:i + self._stride] for i in range(0, len(raw), self._stride))
+        self._y = max(y1, self._y)
+        self._tail_y = self._y - keep
+        return band
+
+    def rows(self, y0: int, y1: int) -> tuple:
+        """
+        Зображення з рядками щонайменше [y0, y1) і номер його першого рядка:
+        зверху може бути рядок контексту з попередньої смуги.
+        """
+        if self._y < y0: self._decode(self._y - 1, y0)
+        first = min(y0, self._y - 1)
+        if first < self._tail_y: raise ValueError("Strip overlap exceeds the reader window")
+        band = self._decode(first, y1)
+        # Нульовий рядок -1 — лише контекст для фільтрів, не частина зображення
+        if first < 0: return band.crop((0, 1, band.width, band.height)), 0
+        return band, first
+
+# Теги, що описують кодування рядків (біти, стиснення, предиктор, палітра, JPEG...)
+_TIFF_CODING_TAGS = (258, 259, 262, 266, 277, 317, 320, 338, 339, 347, 529, 530, 531, 532)
+
+class _TiffRowReader:
+    """
+    TIFF смугами. Pillow декодує стиснений TIFF лише цілим кадром, тож для кожної смуги
+    збирається маленький TIFF з тими самими тегами кодування і лише її strip (нестиснені
+    рядки — лише потрібні) або одним tile (tile — це strip своєї ширини). Tile, що
+    перетинають і наступну смугу, лишаються в пам'яті до неї.
+    """
+
+    def __init__(self, img: Image.Image, file_path: str, max_chunk_bytes: int):
+        tags = img.tag_v2
+        if tags.get(284, 1) != 1: raise ValueError("Planar TIFF cannot be streamed")
+        self.size = width, height = img.size
+        self._tiled = 324 in tags
+        if self._tiled:
+            self._chunk = (tags[322], tags[323])
+            self._offsets, self._counts = tags[324], tags[325]
+        else:
+            self._chunk = (width, min(height, tags.get(278, height)))
+            self._offsets, self._counts = tags[273], tags[279]
+        self._raw = tags.get(259, 1) == 1
+        self._row_bytes = -(-self._chunk[0] * sum(tags.get(258, (1,))) // 8)
+        if not self._raw and self._chunk[0] * self._chunk[1] * 4 > max_chunk_bytes:
+            raise ValueError("TIFF strips are too large to stream")
+        self._tags = tags
+        self._ifh = (b"II*\0" if tags.prefix == b"II" else b"MM\0*") + bytes(4)
+        self._work_mode = "RGBA" if _has_alpha(img) else "RGB"
+        self._cache = {}
+        self._f = open(file_path, "rb")
+
+    @staticmethod
+    def open(img: Image.Image, file_path: str, max_chunk_bytes: int):
+        """Читач для img, якщо його можна декодувати смугами (TIFF без повороту за EXIF); інакше None."""
+        if img.format != 'TIFF' or _exif_orientation(img) != 1: return None
+        try:
+            reader = _TiffRowReader(img, file_path, max_chunk_bytes)
+        except (ValueError, KeyError, TypeError):
+            return None
+        try:
+            reader.rows(0, 1)
+        except (ValueError, OSError, struct.error):
+            reader.close()
+            return None
+        return reader
+
+    def close(self):
+        self._f.close()
+
+    def _read(self, index: int, skip_rows: int = 0, rows: int = None) -> bytes:
+        """Дані фрагмента index; для нестисненого — rows рядків після skip_rows."""
+        count = rows * self._row_bytes if self._raw else self._counts[index]
+        self._f.seek(self._offsets[index] + skip_rows * self._row_bytes)
+        data = self._f.read(count)
+        if len(data) < count: raise ValueError("Truncated TIFF image data")
+        return data
+
+    def _decode(self, parts: list, size: tuple, rows_per_strip: int) -> Image.Image:
+        tiff = io.BytesIO()
+        ifd = TiffImagePlugin.ImageFileDirectory_v2(self._ifh)
+        for tag in _TIFF_CODING_TAGS:
+            if tag in self._tags:
+                ifd.tagtype[tag] = self._tags.tagtype[tag]
+                ifd[tag] = self._tags[tag]
+        ifd[256], ifd[257], ifd[278] = size[0], size[1], rows_per_strip
+        # Зміщення — відносно кінця IFD: Pillow сам зсуває StripOffsets за нього
+        ifd.tagtype[273] = ifd.tagtype[279] = TiffTags.LONG
+        ifd[273] = tuple(itertools.accumulate((len(p) for p in parts[:-1]), initial=0))
+        ifd[279] = tuple(len(p) for p in parts)
+        ifd.save(tiff)
+        for part in parts: tiff.write(part)
+        del parts[:]
+        with Image.open(tiff) as chunk:
+            chunk.load()
+        if chunk.mode not in ("L", "LA", "RGB", "RGBA"): chunk = chunk.convert(self._work_mode)
+        return chunk
+
+    def _strip_band(self, y0: int, y1: int) -> Image.Image:
+        width, height = self.size
+        rows = self._chunk[1]
+        strips = range(y0 // rows, (y1 - 1) // rows + 1)
+        if self._raw:
+            # Нестиснені рядки адресуються напряму і складаються в один strip
+            parts = [self._read(i, max(y0, i * rows) - i * rows, min(y1, (i + 1) * rows) - max(y0, i * rows))
+                     for i in strips]
+            return self._decode(parts, (width, y1 - y0), y1 - y0)
+        top, bottom = strips[0] * rows, min(height, (strips[-1] + 1) * rows)
+        band = self._decode([self._read(i) for i in strips], (width, bottom - top), rows)
+        if (top, bottom) == (y0, y1): return band
+        return band.crop((0, y0 - top, width, y1 - top))
+
+    def _tile_band(self, y0: int, y1: int) -> Image.Image:
+        width = self.size[0]
+        tile_w, tile_h = self._chunk
+        across = -(-width // tile_w)
+        band, cache = None, {}
+        for ty in range(y0 // tile_h, (y1 - 1) // tile_h + 1):
+            top = ty * tile_h
+            first, last = max(y0, top), min(y1, top + tile_h)
+            for tx in range(across):
+                index = ty * across + tx
+                if self._raw:
+                    tile = self._decode([self._read(index, first - top, last - first)], (tile_w, last - first), last - first)
+                    tile_top = first
+                else:
+                    tile = self._cache[index] if index in self._cache else self._decode([self._read(index)], (tile_w, tile_h), tile_h)
+                    if top + tile_h > y1: cache[index] = tile
+                    tile_top = top
+                tile = tile.crop((0, first - tile_top, min(tile_w, width - tx * tile_w), last - tile_top))
+                if band is None: band = Image.new(tile.mode, (width, y1 - y0))
+                band.paste(tile, (tx * tile_w, first - y0))
+        self._cache = cache
+        return band
+
+    def rows(self, y0: int, y1: int) -> tuple:
+        """Зображення з рядками [y0, y1) і номер його першого рядка (завжди y0)."""
+        y1 = min(y1, self.size[1])
+        return (self._tile_band(y0, y1) if self._tiled else self._strip_band(y0, y1)), y0
+
+def _row_reader(img: Image.Image, file_path: str, overlap: int, cap_bytes: int):
+    """Читач смуг джерела (PNG або TIFF) або None, якщо формат декодується лише цілим кадром."""
+    return (_PngRowReader.open(img, file_path, overlap)
+            or _TiffRowReader.open(img, file_path, cap_bytes // 4))
+
+def _png_strip_level(png_kwargs: dict) -> int:
+    """
+    Рівень zlib для _PngStripWriter з аргументів профілю: як і енкодер Pillow, optimize
+    означає рівень 9, а без compress_level — типовий 6. Фільтри рядків різняться:
+    Pillow добирає їх сам, смуги завжди пишуться з фільтром Up.
+    """
+    if png_kwargs.get('optimize'): return 9
+    return png_kwargs.get('compress_level', 6)
+
+class _PngStripWriter:
+    """PNG, що пишеться смугами: один потік zlib на всі IDAT, фільтр Up рахує ImageChops."""
+
+    def __init__(self, f, size: tuple, mode: str, compress_level: int, exif_data: bytes = None):
+        self._f = f
+        self._width = size[0]
+        self._deflate = zlib.compressobj(compress_level)
+        self._prev = Image.new(mode, (size[0], 1))
+        f.write(_PNG_SIGNATURE)
+        color_type = 6 if mode == "RGBA" else 2
+        f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, color_type, 0, 0, 0)))
+        if exif_data:
+            if exif_data.startswith(b"Exif\x00\x00"): exif_data = exif_data[6:]
+            f.write(_png_chunk(b"eXIf", exif_data))
+
+    def write(self, band: Image.Image):
+        w, h = band.size
+        above = Image.new(band.mode, band.size)
+        above.paste(self._prev, (0, 0))
+        if h > 1: above.paste(band.crop((0, 0, w, h - 1)), (0, 1))
+        self._prev = band.crop((0, h - 1, w, h))
+        filtered = ImageChops.subtract_modulo(band, above).tobytes()
+        stride = len(filtered) // h
+        rows = b"".join(b"\x02" + filtered[i:i + stride] for i in range(0, len(filtered), stride))
+        self._emit(self._deflate.compress(rows))
+
+    def _emit(self, data: bytes):
+        if data: self._f.write(_png_chunk(b"IDAT", data))
+
+    def close(self):
+        self._emit(self._deflate.flush())
+        self._f.write(_png_chunk(b"IEND", b""))
+
+def _use_strips(img: Image.Image, resize_config: dict) -> bool:
+    """Смуги — для джерел від LARGE_IMAGE_PIXELS; strip_memory_mb = 0 вимикає режим."""
+    if not resize_config.get('strip_memory_mb', STRIP_MEMORY_MB): return False
+    return img.width * img.height >= LARGE_IMAGE_PIXELS
+
+# Image.MAX_IMAGE_PIXELS — глобальний, тож усі відкриття джерел ідуть під замком
+_OPEN_LOCK = threading.Lock()
+
+def _open_image(file_path, max_pixels: int = None) -> Image.Image:
+    """Image.open; max_pixels на час відкриття піднімає захист від бомб (Pillow відмовляє вдвічі вище)."""
+    with _OPEN_LOCK:
+        stock = Image.MAX_IMAGE_PIXELS
+        if max_pixels and stock is not None and stock < max_pixels // 2: Image.MAX_IMAGE_PIXELS = max_pixels // 2
+        try:
+            return Image.open(file_path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = stock
+
+def _open_source(file_path: str, resize_config: dict) -> Image.Image:
+    """Джерело для обробки: з увімкненими смугами — до MAX_SOURCE_PIXELS, інакше зі стандартним лімітом."""
+    strips = resize_config.get('strip_memory_mb', STRIP_MEMORY_MB)
+    return _open_image(file_path, MAX_SOURCE_PIXELS if strips else None)
+
+def _strip_rows(src_size: tuple, new_size: tuple, cap_bytes: int) -> int:
+    """
+    Рядків результату в смузі. На рядок припадає src_h/new_h рядків джерела: декодування
+    смуги тримає до ~12 байт на піксель джерела (стиснені й розпаковані копії рядків, кадр
+    Pillow), горизонтальний прохід LANCZOS — 4 байти на піксель результату, а знак,
+    зведення й кодування — ще кілька RGBA-буферів смуги.
+    """
+    ratio = src_size[1] / float(new_size[1])
+    per_row = ratio * (12 * src_size[0] + 4 * new_size[0]) + 12 * new_size[0]
+    return max(8, min(new_size[1], int(cap_bytes // per_row)))
+
+def _strip_layer(layer: tuple, frame_size: tuple, y0: int, band_h: int) -> tuple:
+    """Частина знака, що потрапляє в смугу [y0, y0 + band_h): (шар, позиція в смузі) або None."""
+    variant_key, wm_resized, pos, gap = layer
+    if pos is None:
+        # Оверлей замощення періодичний: смугу заповнюють рядки клітинки, зсунуті на фазу y0
+        cell = _TILED_OVERLAY_CACHE.get_or_create(("cell", variant_key, gap), lambda: _build_tile_cell(wm_resized, gap))
+        cell_w, cell_h = cell.size
+        phase, rows = y0 % cell_h, min(band_h, cell_h)
+        part = cell.crop((0, phase, cell_w, phase + rows))
+        if phase + rows > cell_h: part.paste(cell.crop((0, 0, cell_w, phase + rows - cell_h)), (0, cell_h - phase))
+        return _tile_fill(part, (frame_size[0], band_h)), (0, 0)
+    x, y = pos
+    top, bottom = max(y, y0), min(y + wm_resized.height, y0 + band_h)
+    if top >= bottom: return None
+    return wm_resized.crop((0, top - y, wm_resized.width, bottom - y)), (x, top - y0)
+
+def _process_strips(img: Image.Image, new_size: tuple, wm_obj: Image.Image, resize_config: dict, output_fmt: str,
+                    quality: int, timer: _StageTimer, out_file=None) -> tuple:
+    """
+    Великий кадр смугами: ресайз (LANCZOS з box по повному джерелу, тож шви не видно),
+    знак і зведення прозорості — смуга за смугою. 8-бітні PNG і TIFF (по strip/tile) ще й
+    декодуються смугами. PNG-результат кодується потоково (в out_file, якщо його передано);
+    JPEG/WEBP Pillow вміє кодувати лише з цілого кадру, тож вони збираються в кадр
+    розміру результату. Повертає (байти або None, stats кодування, декодовано пікселів).
+    """
+    new_w, new_h = new_size
+    # Запас рядків під ядро LANCZOS (радіус 3 у масштабі джерела)
+    margin = int(3 * max(img.height / float(new_h), 1.0)) + 2
+    cap_bytes = resize_config.get('strip_memory_mb', STRIP_MEMORY_MB) * 1024 ** 2
+    reader = _row_reader(img, img.filename, 2 * margin, cap_bytes)
+    if reader:
+        src_size = reader.size
+        exif_data = img.info.get('exif')
+        work_mode = "RGBA" if _has_alpha(img) else "RGB"
+        fetch = reader.rows
+        decoded_pixels = src_size[0] * src_size[1]
+    else:
+        img, exif_data, work_mode, decoded_pixels = _decode_source(img, _oriented_size(img), new_size, timer)
+        src_size = img.size
+        fetch = lambda y0, y1: (img.crop((0, y0, src_size[0], y1)), y0)
+        margin = int(3 * max(src_size[1] / float(new_h), 1.0)) + 2
+
+    try:
+        ratio = src_size[1] / float(new_h)
+        resizing = src_size != new_size
+        band_rows = _strip_rows(src_size, new_size, cap_bytes)
+
+        kernels = _numpy_compositor(resize_config)
+        variant_opacity, opacity = _layer_opacities(resize_config, kernels)
+        layer = None
         if wm_obj:
-            scale = resize_config.get('wm_scale', DEFAULT_CONFIG['wm_scale'])
-            position = resize_config.get('wm_position', DEFAULT_CONFIG['wm_position'])
-            angle = resize_config.get('wm_angle', DEFAULT_CONFIG['wm_angle'])
-            
-            if scale > 0.9: scale = 0.9
-            
-            wm_w_target = int(new_w * scale)
-            if wm_w_target < 10: wm_w_target = 10
-            
-            w_ratio = wm_w_target / float(wm_obj.width)
-            wm_h_target = int(float(wm_obj.height) * w_ratio)
-            if wm_h_target < 1: wm_h_target = 1
-            
-            wm_resized = wm_obj.resize((wm_w_target, wm_h_target), Image.Resampling.LANCZOS)
-
-            if angle != 0:
-                wm_resized = wm_resized.rotate(angle, expand=True, resample=Image.BICUBIC)
-
-            wm_w_final, wm_h_final = wm_resized.size
-
-            if position == 'tiled':
-                gap = resize_config.get('wm_gap', DEFAULT_CONFIG['wm_gap'])
-                overlay = Image.new('RGBA', (new_w, new_h), (0, 0, 0, 0))
-                step_x = wm_w_final + gap
-                step_y = wm_h_final + gap
-                if step_x < 10: step_x = 10
-                if step_y < 10: step_y = 10
-                
-                rows_needed = (new_h // step_y) + 3
-                cols_needed = (new_w // step_x) + 3
-                
-                for row in range(-1, rows_needed):
-                    for col in range(-1, cols_needed):
-                        x = col * step_x + (row * step_x // 2)
-                        y = row * step_y
-                        if x + wm_w_final > 0 and x < new_w and y + wm_h_final > 0 and y < new_h:
-                            overlay.paste(wm_resized, (x, y), wm_resized)
-                img = Image.alpha_composite(img, overlay)
+            layer = _watermark_layer(new_size, wm_obj, resize_config, 1.0, variant_opacity)
+            timer.lap("wm_prepare")
+
+        flatten = output_fmt in ("JPEG", "RGB")
+        out_mode = "RGB" if flatten else work_mode
+        writer = frame = buffer = None
+        encode_ms = 0.0
+        if output_fmt == "PNG":
+            buffer = out_file if out_file is not None else _encode_buffer()
+            png_kwargs = encoder_kwargs(output_fmt, quality, resize_config.get('encoder_profile', DEFAULT_ENCODER_PROFILE))
+            writer = _PngStripWriter(buffer, new_size, out_mode, _png_strip_level(png_kwargs), exif_data)
+        else:
+            frame = Image.new(out_mode, new_size)
+            timer.alloc(frame)
+
+        for y0 in range(0, new_h, band_rows):
+            y1 = min(new_h, y0 + band_rows)
+            top = max(0, int(y0 * ratio) - margin) if resizing else y0
+            bottom = min(src_size[1], math.ceil(y1 * ratio) + margin) if resizing else y1
+            band, band_top = fetch(top, bottom)
+            if band.mode not in ("L", "LA", "RGB", "RGBA") or 'transparency' in band.info:
+                band = band.convert(work_mode)
+            timer.lap("decode")
+            if resizing:
+                band = band.resize((new_w, y1 - y0), Image.Resampling.LANCZOS,
+                                   box=(0, y0 * ratio - band_top, src_size[0], y1 * ratio - band_top))
+            elif band_top != y0 or band.height != y1 - y0:
+                band = band.crop((0, y0 - band_top, new_w, y1 - band_top))
+            if band.mode != work_mode: band = band.convert(work_mode)
+            timer.lap("resize")
+
+            part = _strip_layer(layer, new_size, y0, y1 - y0) if layer else None
+            if part:
+                band = _composite(band, part[0], part[1], opacity, kernels, flatten)
+                timer.lap("composite")
+            if flatten and band.mode == "RGBA":
+                background = Image.new("RGB", band.size, (255, 255, 255))
+                background.paste(band, mask=band.getchannel("A"))
+                band = background
+            timer.lap("flatten")
+
+            if writer:
+                encode_started = time.perf_counter()
+                writer.write(band)
+                encode_ms += (time.perf_counter() - encode_started) * 1000
+                timer.lap("encode")
             else:
-                margin = resize_config.get('wm_margin', DEFAULT_CONFIG['wm_margin'])
-                pos_x, pos_y = 0, 0
-                if position == 'bottom-right': 
-                    pos_x, pos_y = new_w - wm_w_final - margin, new_h - wm_h_final - margin
-                elif position == 'bottom-left': 
-                    pos_x, pos_y = margin, new_h - wm_h_final - margin
-                elif position == 'top-right': 
-                    pos_x, pos_y = new_w - wm_w_final - margin, margin
-                elif position == 'top-left': 
-                    pos_x, pos_y = margin, margin
-                elif position == 'center': 
-                    pos_x, pos_y = (new_w - wm_w_final) // 2, (new_h - wm_h_final) // 2
-                
-                pos_x = max(0, min(pos_x, new_w - wm_w_final))
-                pos_y = max(0, min(pos_y, new_h - wm_h_final))
-                img.paste(wm_resized, (pos_x, pos_y), wm_resized)
-
-        # Export
+                frame.paste(band, (0, y0))
+    finally:
+        if reader: reader.close()
+
+    if frame is not None:
+        result_bytes, encode_stats = _encode_frame(frame, resize_config, output_fmt, quality, exif_data, timer)
+        return result_bytes, encode_stats, decoded_pixels
+
+    encode_started = time.perf_counter()
+    writer.close()
+    timer.lap("encode")
+    encode_stats = {"encode_ms": encode_ms + (time.perf_counter() - encode_started) * 1000, "quality": None}
+    if out_file is not None: return None, encode_stats, decoded_pixels
+    return buffer.getvalue(), encode_stats, decoded_pixels
+
+# --- RENDITIONS ---
+# Стандартні розміри для набору версій (Max Side, px)
+RENDITION_SIZES = {"4K": 3840, "FHD": 1920, "HD": 1280}
+
+def build_renditions(size_labels: list, formats: list, quality: int) -> list:
+    """
+    Набір версій — список dict {'suffix', 'value', 'output_fmt', 'quality'}.
+    Суфікс (мітка розміру) розрізняє імена файлів; формати — розширення.
+    """
+    return [{'suffix': label.lower(), 'enabled': True, 'mode': 'Max Side', 'value': RENDITION_SIZES[label],
+             'output_fmt': fmt, 'quality': quality}
+            for label in size_labels for fmt in formats]
+
+def _rendition_config(resize_config: dict, rendition: dict) -> dict:
+    return dict(resize_config, **{k: v for k, v in rendition.items() if k in ('value', 'mode', 'enabled')})
+
+def process_renditions(file_path: str, filenames: list, wm_obj: Image.Image, resize_config: dict, renditions: list,
+                       profile: bool = False) -> list:
+    """
+    Усі версії одного фото з одного декодування: кадр масштабується каскадом
+    від найбільшої версії до найменшої, знак накладається на копію кожної.
+    Поля rendition перекривають resize_config ('value', 'mode') та формат/якість.
+    Повертає список (байти, stats) у порядку renditions.
+    """
+    timer = _StageTimer(profile)
+    with _open_image(file_path) as img:
+        orig_w, orig_h = _oriented_size(img)
+        orig_size = os.path.getsize(file_path)
+        configs = [_rendition_config(resize_config, r) for r in renditions]
+        targets = [_target_size(orig_w, orig_h, cfg) for cfg in configs]
+        largest = max(targets, key=lambda t: t[0] * t[1])
+        timer.lap("open")
+
+        base, exif_data, work_mode, decoded_pixels = _decode_source(img, (orig_w, orig_h), largest[:2], timer)
+
+        results = [None] * len(renditions)
+        frame = base
+        # Від більшого до меншого: кожен крок масштабує попередній (вже менший) кадр
+        for i in sorted(range(len(renditions)), key=lambda i: targets[i][0] * targets[i][1], reverse=True):
+            new_w, new_h, scale_factor = targets[i]
+            # Збільшення (Exact Width/Height) рахуємо від декодованого кадру, а не від меншої версії
+            source = frame if frame.width >= new_w and frame.height >= new_h else base
+            frame = _resize_frame(source, (new_w, new_h), work_mode, timer)
+            # Непрозорий кадр лишається RGB і для менших версій
+            work_mode = frame.mode if frame.mode in ("RGB", "RGBA") else work_mode
+            r = renditions[i]
+            output_fmt = r.get('output_fmt', 'JPEG')
+            result_bytes, encode_stats = _finish_frame(frame.copy(), wm_obj, configs[i], output_fmt,
+                                                       r.get('quality', 80), exif_data, timer)
+            stats = _frame_stats(filenames[i], (orig_w, orig_h), (new_w, new_h), orig_size, len(result_bytes),
+                                 scale_factor, encode_stats, timer, decoded_pixels)
+            stats['rendition'] = r.get('suffix', '')
+            results[i] = (result_bytes, stats)
+            # Спільні етапи (відкриття, декодування) враховано лише в першій версії
+            timer = _StageTimer(profile)
+            decoded_pixels = 0
+        return results
+
+def process_renditions_to_files(file_path: str, out_paths: list, wm_obj: Image.Image, resize_config: dict,
+                                renditions: list, profile: bool = False) -> list:
+    """Як process_image_to_file, але для набору версій; повертає список stats."""
+    started = time.perf_counter()
+    results = process_renditions(file_path, [os.path.basename(p) for p in out_paths], wm_obj, resize_config,
+                                 renditions, profile)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    report = []
+    for out_path, (result_bytes, stats) in zip(out_paths, results):
+        _write_atomic(out_path, result_bytes)
+        stats['output_path'] = out_path
+        stats['elapsed_ms'] = elapsed_ms / len(results)
+        report.append(stats)
+    return report
+
+# --- PREVIEW ---
+def _load_preview_proxy(file_path: str, max_side: int) -> tuple:
+    with _open_image(file_path) as img:
+        orig_size = _oriented_size(img)
+        if img.format == 'JPEG': img.draft(None, (max_side, max_side))
+        if _exif_orientation(img) != 1:
+            img = ImageOps.exif_transpose(img)
+        work_mode = "RGBA" if _has_alpha(img) else "RGB"
+        if img.mode != work_mode:
+            img = img.convert(work_mode)
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        img.load()
+    return img, orig_size
+
+def _checkerboard(size: tuple, cell: int = 12) -> Image.Image:
+    tile = Image.new("RGBA", (cell * 2, cell * 2), (255, 255, 255, 255))
+    tile.paste((204, 204, 204, 255), (cell, 0, cell * 2, cell))
+    tile.paste((204, 204, 204, 255), (0, cell, cell, cell * 2))
+    return _tile_fill(tile, size).convert("RGB")
+
+def get_preview_proxy(file_path: str, max_side: int = PREVIEW_MAX_SIDE) -> tuple:
+    """(зменшена копія під розмір екрана, розмір оригіналу) з LRU-кешу; інвалідація за mtime."""
+    key = (file_path, os.path.getmtime(file_path), max_side)
+    return _PREVIEW_PROXY_CACHE.get_or_create(key, lambda: _load_preview_proxy(file_path, max_side))
+
+def render_preview(file_path: str, wm_obj: Image.Image, resize_config: dict, output_fmt: str,
+                   max_side: int = PREVIEW_MAX_SIDE) -> tuple:
+    """
+    Швидке прев'ю з кешованої копії: без повного декодування та повільного енкодера.
+    Повертає (байти зображення, stats) з тими ж полями розміру, що й process_image,
+    крім new_size — точну вагу дає лише повний process_image.
+    """
+    proxy, (orig_w, orig_h) = get_preview_proxy(file_path, max_side)
+    new_w, new_h, scale_factor = _target_size(orig_w, orig_h, resize_config)
+    px_scale = min(1.0, max_side / float(max(new_w, new_h)))
+    disp_size = (max(1, round(new_w * px_scale)), max(1, round(new_h * px_scale)))
+
+    if proxy.size != disp_size:
+        img = proxy.resize(disp_size, Image.Resampling.BICUBIC)
+    else:
+        img = proxy.copy()
+    if wm_obj:
+        img = _apply_watermark(img, wm_obj, resize_config, px_scale=px_scale, flatten=output_fmt == "JPEG")
+
+    # Прозорість показуємо на «шахівниці» (для JPEG — на білому, як у фінальному файлі),
+    # щоб завжди кодувати швидким JPEG замість PNG
+    if img.mode == "RGBA":
         if output_fmt == "JPEG":
             background = Image.new("RGB", img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[3])
-            img = background
-        elif output_fmt == "RGB":
-            img = img.convert("RGB")
+        else:
+            background = _checkerboard(img.size)
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    output_buffer = io.BytesIO()
+    img.save(output_buffer, format="JPEG", quality=85)
 
-        output_buffer = io.BytesIO()
-        save_kwargs = {}
-        if exif_data: save_kwargs['exif'] = exif_data
+    stats = {
+        "orig_res": f"{orig_w}x{orig_h}",
+        "new_res": f"{new_w}x{new_h}",
+        "orig_size": os.path.getsize(file_path),
+        "scale_factor": f"{scale_factor:.2f}x"
+    }
+    return output_buffer.getvalue(), stats
 
-        if output_fmt == "JPEG":
-            save_kwargs.update({"format": "JPEG", "quality": quality, "optimize": True, "subsampling": 0})
-        elif output_fmt == "WEBP":
-            save_kwargs.update({"format": "WEBP", "quality": quality, "method": 6})
-        elif output_fmt == "PNG":
-            save_kwargs.update({"format": "PNG", "optimize": True})
+# --- RESULT CACHE ---
+# Вхідні файли -> blake2b вмісту; інвалідація за розміром і mtime
+# (шлях, розмір, mtime_ns) -> хеш вмісту
+_FILE_DIGESTS = _LRUCache(FILE_DIGEST_CACHE_SIZE)
 
-        img.save(output_buffer, **save_kwargs)
-        result_bytes = output_buffer.getvalue()
-        
-        stats = {
-            "filename": filename,
-            "orig_res": f"{orig_w}x{orig_h}",
-            "new_res": f"{new_w}x{new_h}",
-            "orig_size": orig_size,
-            "new_size": len(result_bytes),
-            "scale_factor": f"{scale_factor:.2f}x"
+def _hash_file(file_path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_digest(file_path: str) -> str:
+    """Хеш вмісту файлу (читається блоками); повторні виклики — з пам'яті."""
+    st = os.stat(file_path)
+    return _FILE_DIGESTS.get_or_create((file_path, st.st_size, st.st_mtime_ns), lambda: _hash_file(file_path))
+
+def _normalized_settings(wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int) -> dict:
+    """Лише ті налаштування, що впливають на байти результату, зі значеннями за замовчуванням."""
+    settings = {'version': RESULT_CACHE_VERSION, 'format': output_fmt,
+                'encoder_profile': resize_config.get('encoder_profile', DEFAULT_ENCODER_PROFILE)}
+    if resize_config.get('enabled', False):
+        settings['resize'] = [resize_config.get('mode', 'Max Side'), resize_config.get('value', 1920)]
+    if output_fmt in ("JPEG", "WEBP"):
+        settings['quality'] = quality
+        if resize_config.get('target_size_kb'): settings['target_size_kb'] = resize_config['target_size_kb']
+    if wm_obj:
+        position = resize_config.get('wm_position', DEFAULT_CONFIG['wm_position'])
+        settings['wm'] = [_watermark_token(wm_obj), position,
+                          resize_config.get('wm_scale', DEFAULT_CONFIG['wm_scale']),
+                          resize_config.get('wm_angle', DEFAULT_CONFIG['wm_angle']),
+                          round(resize_config.get('wm_opacity', DEFAULT_CONFIG['wm_opacity']), 3)]
+        if position == 'tiled':
+            settings['wm'].append(resize_config.get('wm_gap', DEFAULT_CONFIG['wm_gap']))
+        else:
+            settings['wm'].append(resize_config.get('wm_margin', DEFAULT_CONFIG['wm_margin']))
+        # Ядра NumPy округлюють інакше за PIL (до 1 LSB), тож їхні результати кешуються окремо
+        if _numpy_compositor(resize_config): settings['compositor'] = 'numpy'
+    return settings
+
+class ResultCache:
+    """
+    Дисковий кеш готових результатів, адресований вмістом: ключ — хеш вхідного
+    файлу, нормалізованих налаштувань і лого. Ім'я результату в ключ не входить,
+    тож зміна найменування лише копіює (hardlink) готовий файл без перекодування.
+
+    Блоб і результат користувача — той самий inode (hardlink у put і get, копія лише
+    між різними файловими системами). Тому час використання ведеться за mtime
+    .json-файла, а не блоба, а запис пам'ятає розмір і mtime блоба: результат,
+    змінений на місці, робить запис недійсним замість того, щоб роздаватися далі.
+    Інструменти, що правлять файл на місці й відновлюють mtime, цю перевірку обходять.
+
+    Усі операції — над файлами в cache_dir, тому об'єкт можна передавати в
+    процеси-воркери. Розмір обмежено max_bytes: trim() видаляє найдавніше
+    використані записи (LRU). Лічильники влучань веде run_batch.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_path: str, wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int) -> str:
+        settings = json.dumps(_normalized_settings(wm_obj, resize_config, output_fmt, quality), sort_keys=True)
+        return hashlib.blake2b(f"{file_digest(file_path)}|{settings}".encode(), digest_size=20).hexdigest()
+
+    def _paths(self, key: str) -> tuple:
+        return os.path.join(self.cache_dir, key + ".bin"), os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key: str, out_path: str) -> dict:
+        """Кладе кешований результат в out_path і повертає його stats; None — промах."""
+        blob_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, encoding="utf-8") as f: stats = json.load(f)
+            blob = stats.pop('_blob', None)
+            st = os.stat(blob_path)
+            if blob and blob != [st.st_size, st.st_mtime_ns]:
+                # Спільний inode змінили на місці через чийсь результат
+                self._remove(key)
+                return None
+            tmp_path = out_path + ".part"
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            try:
+                os.link(blob_path, tmp_path)
+            except OSError:
+                shutil.copyfile(blob_path, tmp_path)
+            os.replace(tmp_path, out_path)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        return stats
+
+    def _write_entry_file(self, final_path: str, write, mode: int):
+        """
+        Пише файл запису під унікальним тимчасовим ім'ям і атомарно підміняє ним final_path.
+        Кеш спільний для сесій і процесів: фіксоване ім'я .part дало б двом записувачам
+        одного ключа перейменувати недописаний файл іншого.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        try:
+            # mkstemp створює 0600, а блоб потім hardlink-ом стає результатом користувача
+            os.chmod(tmp_path, mode)
+            with os.fdopen(fd, "wb") as f: write(f)
+            os.replace(tmp_path, final_path)
+        except BaseException:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+
+    def _link_blob(self, out_path: str, blob_path: str) -> bool:
+        """Hardlink результату як блоба (атомарно); False — файлова система не дозволяє."""
+        tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            os.link(out_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        except OSError:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            return False
+        return True
+
+    def put(self, key: str, out_path: str, stats: dict):
+        blob_path, meta_path = self._paths(key)
+        meta = {k: v for k, v in stats.items() if k not in _UNCACHED_STATS}
+        try:
+            mode = os.stat(out_path).st_mode & 0o777
+            if not self._link_blob(out_path, blob_path):
+                def copy_blob(f):
+                    with open(out_path, "rb") as src: shutil.copyfileobj(src, f)
+                self._write_entry_file(blob_path, copy_blob, mode)
+            st = os.stat(blob_path)
+            meta['_blob'] = [st.st_size, st.st_mtime_ns]
+            self._write_entry_file(meta_path, lambda f: f.write(json.dumps(meta).encode("utf-8")), mode)
+        except OSError:
+            pass  # Кеш — лише оптимізація: збій запису не валить обробку
+
+    def record(self, hit: bool):
+        if hit: self.hits += 1
+        else: self.misses += 1
+
+    def _entries(self) -> list:
+        """[(час використання, розмір, ключ)] від найдавнішого."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".bin"): continue
+            key = name[:-4]
+            try:
+                blob = os.stat(os.path.join(self.cache_dir, name))
+                meta = os.stat(os.path.join(self.cache_dir, key + ".json"))
+            except OSError:
+                continue
+            entries.append((meta.st_mtime, blob.st_size + meta.st_size, key))
+        return sorted(entries)
+
+    def _remove(self, key: str):
+        for path in self._paths(key):
+            try: os.remove(path)
+            except OSError: pass
+
+    def trim(self) -> int:
+        """Видаляє найдавніші записи, доки кеш не вкладеться в max_bytes; повертає кількість видалених."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, key in entries:
+            if total <= self.max_bytes: break
+            self._remove(key)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        for _, _, key in self._entries():
+            self._remove(key)
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        total = self.hits + self.misses
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
         }
-        return result_bytes, stats
+
+# Поля stats, що описують конкретний запуск, а не результат
+_UNCACHED_STATS = ("filename", "output_path", "elapsed_ms", "timings", "decoded_pixels", "alloc_bytes", "cache_hit")
+
+# --- INGESTION ---
+def probe_image(file_path: str) -> dict:
+    """Параметри із заголовка (без декодування): розмір з урахуванням EXIF, орієнтація, прозорість."""
+    with _open_image(file_path) as img:
+        width, height = _oriented_size(img)
+        return {
+            "width": width,
+            "height": height,
+            "orientation": _exif_orientation(img),
+            "has_alpha": _has_alpha(img),
+            "format": img.format,
+            "mode": img.mode
+        }
+
+def _unique_name(file_name: str, taken: set) -> str:
+    if file_name not in taken: return file_name
+    base, ext = os.path.splitext(file_name)
+    n = 2
+    while f"{base}_{n}{ext}" in taken: n += 1
+    return f"{base}_{n}{ext}"
+
+def ingest_upload(stream, file_name: str, dest_dir: str, index: dict) -> dict:
+    """
+    Копіює потік завантаження в dest_dir блоками по INGEST_CHUNK_SIZE, паралельно рахуючи хеш.
+    index — індекс сесії {хеш вмісту: запис}: однаковий вміст зберігається один раз
+    (повертається наявний запис з duplicate=True). Інший вміст під уже зайнятим
+    ім'ям отримує суфікс _2, _3..., щоб імена результатів не збігалися.
+    Запис містить path, name, digest, size і поля probe_image.
+    """
+    if hasattr(stream, "seek"): stream.seek(0)
+    h = hashlib.blake2b(digest_size=16)
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: stream.read(INGEST_CHUNK_SIZE), b""):
+                h.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        digest = h.hexdigest()
+        if digest in index:
+            os.remove(tmp_path)
+            return dict(index[digest], duplicate=True)
+
+        name = _unique_name(os.path.basename(file_name), {r["name"] for r in index.values()})
+        path = os.path.join(dest_dir, name)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+    record = {"path": path, "name": name, "digest": digest, "size": size}
+    try:
+        record.update(probe_image(path))
+    except (OSError, Image.DecompressionBombError) as e:
+        os.remove(path)  # Не зображення, пошкоджений або завеликий файл: у сесії його не лишаємо
+        if isinstance(e, OSError): raise
+        raise OSError(str(e)) from e
+    index[digest] = record
+    # Хеш уже пораховано: кеш результатів не читатиме файл повторно
+    st = os.stat(path)
+    _FILE_DIGESTS.put((path, st.st_size, st.st_mtime_ns), digest)
+    return dict(record, duplicate=False)
+
+# --- MEMORY BUDGET ---
+def default_memory_budget() -> int:
+    """
+    Частка доступної RAM (з урахуванням ліміту cgroup у контейнері). На Linux — MemAvailable:
+    вільні сторінки (SC_AVPHYS_PAGES) не враховують кеш, який ядро звільнить на вимогу.
+    """
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    if available is None:
+        try:
+            available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        except (ValueError, OSError, AttributeError):
+            available = MEMORY_BUDGET_FALLBACK
+    for limit_path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(limit_path) as f: limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit(): available = min(available, int(limit))
+    return int(available * MEMORY_BUDGET_SHARE)
+
+def _draft_size(size: tuple, request: tuple) -> tuple:
+    """Розмір, до якого JPEG draft зменшить кадр (кроки 1/2, 1/4, 1/8)."""
+    w, h = size
+    for scale in (8, 4, 2):
+        if -(-w // scale) >= request[0] and -(-h // scale) >= request[1]:
+            return -(-w // scale), -(-h // scale)
+    return size
+
+def _encoder_bytes_per_pixel(output_fmt: str, profile: str) -> float:
+    """Робочий буфер енкодера на піксель: optimize/progressive JPEG і WEBP тримають увесь кадр."""
+    kwargs = encoder_kwargs(output_fmt, 80, profile)
+    if output_fmt == "JPEG" and (kwargs.get('optimize') or kwargs.get('progressive')):
+        return 6 if kwargs.get('subsampling') == 0 else 3
+    if output_fmt == "WEBP": return 6
+    return 0.5
+
+def estimate_job_memory(file_path: str, wm_obj: Image.Image, resize_config: dict, output_fmt: str,
+                        renditions: list = None) -> int:
+    """
+    Оцінка пікової пам'яті одного job лише із заголовка файлу. Pillow тримає
+    багатоканальні кадри по 4 байти на піксель; декодований кадр живе до кінця job,
+    поруч — повернута копія, кадр після ресайзу і найбільше з: копії для зведення
+    прозорості, оверлею замощення та буфера енкодера. У режимі смуг — бюджет смуг
+    плюс те, що Pillow не вміє обробляти частинами.
+    """
+    with (_open_image(file_path) if renditions else _open_source(file_path, resize_config)) as img:
+        orig_w, orig_h = _oriented_size(img)
+        rotated = _exif_orientation(img) != 1
+        # Лише L лишається однобайтовим; P/1/CMYK однаково конвертуються в RGB(A)
+        src_bpp = 1 if img.mode == "L" else 4
+        configs = [_rendition_config(resize_config, r) for r in renditions] if renditions else [resize_config]
+        formats = [r.get('output_fmt', 'JPEG') for r in renditions] if renditions else [output_fmt]
+        targets = [_target_size(orig_w, orig_h, cfg)[:2] for cfg in configs]
+        new_w, new_h = max(targets, key=lambda t: t[0] * t[1])
+
+        decoded = img.size
+        if img.format == 'JPEG' and (new_w < orig_w or new_h < orig_h):
+            req = (int(new_w * DRAFT_REDUCING_GAP), int(new_h * DRAFT_REDUCING_GAP))
+            if img.size != (orig_w, orig_h): req = req[::-1]
+            decoded = _draft_size(img.size, req)
+
+        strips = not renditions and _use_strips(img, resize_config)
+        streamed = False
+        if strips:
+            reader = _row_reader(img, file_path, 0, resize_config.get('strip_memory_mb', STRIP_MEMORY_MB) * 1024 ** 2)
+            if reader:
+                reader.close()
+                streamed = True
+
+    decoded_bytes = decoded[0] * decoded[1] * src_bpp
+    new_px = new_w * new_h
+    frame_bytes = new_px * 4
+    profile = resize_config.get('encoder_profile', DEFAULT_ENCODER_PROFILE)
+    encoder_bytes = new_px * max(_encoder_bytes_per_pixel(fmt, profile) for fmt in formats)
+    if strips:
+        # Смуги тримаються в межах strip_memory_mb; потоковий PNG не тримає ні джерела, ні результату
+        peak = resize_config.get('strip_memory_mb', STRIP_MEMORY_MB) * 1024 ** 2
+        if not streamed: peak += decoded_bytes * (2 if rotated else 1)
+        if output_fmt != "PNG": peak += frame_bytes + encoder_bytes
+        return int(peak) + MEMORY_JOB_OVERHEAD
+    overlay_bytes = frame_bytes if wm_obj and resize_config.get('wm_position') == 'tiled' else 0
+
+    peak = decoded_bytes * (2 if rotated else 1) + frame_bytes + max(frame_bytes, overlay_bytes, encoder_bytes)
+    # Набір версій тримає ще й каскадний кадр
+    if renditions and len(renditions) > 1: peak += frame_bytes
+    return int(peak) + MEMORY_JOB_OVERHEAD
+
+class MemoryBudget:
+    """
+    Допуск jobs у run_batch за оцінкою пам'яті: сума оцінок запущених jobs
+    не перевищує max_bytes, тож великі фото йдуть з малою паралельністю, а малі — широко.
+    Job, більший за весь бюджет, запускається сам. Рішення пишуться в events.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes or default_memory_budget()
+        self.in_flight = 0
+        self.running = 0
+        self.peak_bytes = 0
+        self.peak_running = 0
+        self.admitted = 0
+        self.events = []
+        self._waiting = None
+
+    def try_admit(self, file_path: str, estimate: int) -> bool:
+        fits = self.in_flight + estimate <= self.max_bytes
+        if self.running and not fits:
+            # Одна подія на job: фіксуємо стан у момент першої відмови
+            if self._waiting is None:
+                self._waiting = {"file": file_path, "estimate": estimate, "in_flight": self.in_flight,
+                                 "running": self.running, "decision": "throttled", "started": time.perf_counter()}
+                self.events.append(self._waiting)
+            return False
+        if self._waiting is not None:
+            self._waiting["waited_ms"] = (time.perf_counter() - self._waiting.pop("started")) * 1000
+            self._waiting = None
+        if not fits:
+            self.events.append({"file": file_path, "estimate": estimate, "in_flight": 0,
+                                "running": 0, "decision": "oversize"})
+        self.in_flight += estimate
+        self.running += 1
+        self.admitted += 1
+        self.peak_bytes = max(self.peak_bytes, self.in_flight)
+        self.peak_running = max(self.peak_running, self.running)
+        return True
+
+    def release(self, estimate: int):
+        self.in_flight -= estimate
+        self.running -= 1
+
+    def summary(self) -> dict:
+        return {
+            "budget": self.max_bytes,
+            "jobs": self.admitted,
+            "peak_bytes": self.peak_bytes,
+            "peak_running": self.peak_running,
+            "throttled": sum(1 for e in self.events if e["decision"] == "throttled"),
+            "oversize": sum(1 for e in self.events if e["decision"] == "oversize"),
+        }
+
+# --- BATCH EXECUTION ---
+BACKENDS = ("thread", "process")
+
+# Лого, передане процесу-воркеру один раз при старті пулу
+_WORKER_WM = None
+
+def _init_process_worker(wm_obj: Image.Image):
+    global _WORKER_WM
+    _WORKER_WM = wm_obj
+
+def _run_job(file_path: str, dst, wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int,
+             profile: bool = False, renditions: list = None, result_cache: ResultCache = None):
+    """
+    Один job run_batch: dst — шлях (або список шляхів для renditions).
+    З result_cache спершу шукає готові результати; набір версій береться з кешу
+    лише повністю, інакше перераховується з одного декодування.
+    """
+    started = time.perf_counter()
+    out_paths = dst if renditions else [dst]
+    if result_cache:
+        if renditions:
+            keys = [result_cache.key(file_path, wm_obj, _rendition_config(resize_config, r),
+                                     r.get('output_fmt', 'JPEG'), r.get('quality', 80)) for r in renditions]
+        else:
+            keys = [result_cache.key(file_path, wm_obj, resize_config, output_fmt, quality)]
+        cached = [result_cache.get(key, path) for key, path in zip(keys, out_paths)]
+        if all(stats is not None for stats in cached):
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            for stats, path in zip(cached, out_paths):
+                stats.update(filename=os.path.basename(path), output_path=path,
+                             elapsed_ms=elapsed_ms / len(cached), cache_hit=True)
+                if profile:
+                    stats['timings'] = {stage: 0.0 for stage in STAGES}
+                    stats['decoded_pixels'] = stats['alloc_bytes'] = 0
+            return cached if renditions else cached[0]
+
+    if renditions:
+        report = process_renditions_to_files(file_path, out_paths, wm_obj, resize_config, renditions, profile)
+    else:
+        report = [process_image_to_file(file_path, dst, wm_obj, resize_config, output_fmt, quality, profile)]
+    if result_cache:
+        for key, stats in zip(keys, report):
+            result_cache.put(key, stats['output_path'], stats)
+            stats['cache_hit'] = False
+    return report if renditions else report[0]
+
+def _job_in_worker(file_path: str, dst, resize_config: dict, output_fmt: str, quality: int,
+                   profile: bool = False, renditions: list = None, result_cache: ResultCache = None):
+    return _run_job(file_path, dst, _WORKER_WM, resize_config, output_fmt, quality, profile, renditions, result_cache)
+
+def _process_executor(max_workers: int, wm_obj: Image.Image) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Пул процесів для backend="process". spawn, а не fork: у веб-сервері інші потоки можуть
+    тримати локи рушія (кеші, мініатюри), і форкнутий воркер успадкував би їх захопленими назавжди.
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_process_worker, initargs=(wm_obj,))
+
+def run_batch(jobs: list, wm_obj: Image.Image, resize_config: dict, output_fmt: str, quality: int,
+              max_workers: int = 2, backend: str = "thread", profile: bool = False, renditions: list = None,
+              result_cache: ResultCache = None, memory_budget: MemoryBudget = None,
+              pool: WorkerPool = None, session: str = "default"):
+    """
+    Паралельно обробляє jobs — список пар (file_path, out_path).
+    Генерує (file_path, stats, error) у порядку завершення.
+
+    З renditions (див. build_renditions) out_path — список шляхів у порядку
+    версій, а stats — список stats усіх версій одного фото (одне декодування).
+
+    result_cache (ResultCache) пропускає вже пораховані результати: stats
+    отримують cache_hit, лічильники кешу оновлюються, розмір підрізається.
+
+    memory_budget (MemoryBudget) запускає job лише тоді, коли його оцінка пам'яті
+    (estimate_job_memory) вкладається в бюджет поряд із уже запущеними;
+    max_workers лишається верхньою межею. stats отримують mem_estimate і queued_ms.
+
+    backend="process" запускає ProcessPoolExecutor: лого серіалізується один раз
+    на воркер (initializer), а назад повертаються лише шляхи та stats.
+
+    pool (WorkerPool) замість власного виконавця ставить jobs у спільний пул
+    з пакетним пріоритетом від імені session; max_workers тоді обмежує лише jobs
+    цього батчу в роботі, а загальну паралельність — сам пул. stats отримують pool_wait_ms.
+    З backend="process" job виконується в процесі, але місце в пулі займає весь
+    цей час, тож процеси теж входять у загальний ліміт.
+    Якщо генератор закрито достроково, ще не запущені jobs скасовуються.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    executor = None
+    if pool is not None and backend == "process":
+        executor = _process_executor(max_workers, wm_obj)
+        def in_process(src, dst):
+            return executor.submit(_job_in_worker, src, dst, resize_config, output_fmt, quality,
+                                   profile, renditions, result_cache).result()
+        def submit(src, dst):
+            return pool.submit(in_process, src, dst, session=session, priority=PRIORITY_BULK)
+    elif pool is not None:
+        def submit(src, dst):
+            return pool.submit(_run_job, src, dst, wm_obj, resize_config, output_fmt, quality,
+                               profile, renditions, result_cache, session=session, priority=PRIORITY_BULK)
+    elif backend == "process":
+        executor = _process_executor(max_workers, wm_obj)
+        def submit(src, dst):
+            return executor.submit(_job_in_worker, src, dst, resize_config, output_fmt, quality,
+                                   profile, renditions, result_cache)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        def submit(src, dst):
+            return executor.submit(_run_job, src, dst, wm_obj, resize_config, output_fmt, quality,
+                                   profile, renditions, result_cache)
+
+    pending = deque(jobs)
+    futures = {}
+    batch_started = time.perf_counter()
+
+    def fill():
+        # Без бюджету й пулу все йде в чергу виконавця одразу; інакше — по черзі, доки вміщається
+        while pending:
+            src, dst = pending[0]
+            estimate = 0
+            # З бюджетом чи спільним пулом max_workers обмежує jobs цього батчу в роботі
+            if (memory_budget or pool is not None) and len(futures) >= max_workers: return
+            if memory_budget:
+                try:
+                    estimate = estimate_job_memory(src, wm_obj, resize_config, output_fmt, renditions)
+                except (OSError, ValueError):
+                    estimate = 0  # Нечитабельний файл: помилку покаже сам job
+                if not memory_budget.try_admit(src, estimate): return
+            pending.popleft()
+            futures[submit(src, dst)] = (src, estimate, (time.perf_counter() - batch_started) * 1000)
+
+    try:
+        fill()
+        done = 0
+        while futures:
+            finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in finished:
+                src, estimate, queued_ms = futures.pop(fut)
+                if memory_budget: memory_budget.release(estimate)
+                done += 1
+                try:
+                    stats = fut.result()
+                except Exception as e:
+                    yield src, None, e
+                    continue
+                for item in (stats if renditions else [stats]):
+                    if result_cache: result_cache.record(item['cache_hit'])
+                    if memory_budget: item.update(mem_estimate=estimate, queued_ms=queued_ms)
+                    if pool is not None: item['pool_wait_ms'] = fut.wait_ms
+                if result_cache and done % 50 == 0: result_cache.trim()
+                yield src, stats, None
+            fill()
+    finally:
+        for fut in futures: fut.cancel()
+        if executor: executor.shutdown(wait=True)
+    if result_cache: result_cache.trim()
+
+# --- PIPELINE ---
+OUTPUT_FORMATS = ("JPEG", "WEBP", "PNG")
+RESIZE_MODES = ("Max Side", "Exact Width", "Exact Height")
+WM_POSITIONS = ("bottom-right", "bottom-left", "top-right", "top-left", "center", "tiled")
+
+def compile_config(resize_config: dict) -> dict:
+    """
+    Перевіряє resize_config і повертає повну копію: усі значення за замовчуванням
+    підставлені, масштаб обмежено, відступ або проміжок обнулено за позицією.
+    Результат обробки той самий, що й з вихідним словником. Помилки — ValueError.
+    """
+    cfg = {'enabled': False, 'mode': 'Max Side', 'value': 1920, **DEFAULT_CONFIG,
+           'encoder_profile': DEFAULT_ENCODER_PROFILE, 'target_size_kb': 0,
+           'compositor': DEFAULT_COMPOSITOR, 'strip_memory_mb': STRIP_MEMORY_MB}
+    cfg.update(resize_config)
+
+    if cfg['mode'] not in RESIZE_MODES: raise ValueError(f"Unknown resize mode: {cfg['mode']}")
+    if cfg['enabled'] and cfg['value'] < 1: raise ValueError(f"Invalid resize value: {cfg['value']}")
+    if cfg['wm_position'] not in WM_POSITIONS: raise ValueError(f"Unknown watermark position: {cfg['wm_position']}")
+    if cfg['wm_scale'] <= 0: raise ValueError(f"Invalid watermark scale: {cfg['wm_scale']}")
+    if not 0 <= cfg['wm_opacity'] <= 1: raise ValueError(f"Invalid watermark opacity: {cfg['wm_opacity']}")
+    if cfg['wm_margin'] < 0 or cfg['wm_gap'] < 0: raise ValueError("Watermark margin and gap must not be negative")
+    if cfg['encoder_profile'] not in ENCODER_PROFILES: raise ValueError(f"Unknown encoder profile: {cfg['encoder_profile']}")
+    if cfg['compositor'] not in COMPOSITORS: raise ValueError(f"Unknown compositor: {cfg['compositor']}")
+    if (cfg['target_size_kb'] or 0) < 0 or cfg['strip_memory_mb'] < 0:
+        raise ValueError("Target size and strip memory must not be negative")
+
+    if cfg['wm_scale'] > 0.9: cfg['wm_scale'] = 0.9
+    if cfg['wm_position'] == 'tiled': cfg['wm_margin'] = 0
+    else: cfg['wm_gap'] = 0
+    return cfg
+
+class Pipeline:
+    """
+    Налаштування пакета, скомпільовані один раз: перевірений повний конфіг і знак
+    із порахованим токеном та готовим варіантом під типову ширину результату.
+    Спільний для CLI, веб-додатку, бенчмарків і hot folder.
+    """
+
+    def __init__(self, wm_obj: Image.Image, resize_config: dict, output_fmt: str = "JPEG", quality: int = 80,
+                 renditions: list = None):
+        if output_fmt not in OUTPUT_FORMATS: raise ValueError(f"Unknown output format: {output_fmt}")
+        if not 1 <= quality <= 100: raise ValueError(f"Invalid quality: {quality}")
+        for r in renditions or []:
+            if r.get('output_fmt', 'JPEG') not in OUTPUT_FORMATS: raise ValueError(f"Unknown output format: {r['output_fmt']}")
+        self.wm_obj = wm_obj
+        self.config = compile_config(resize_config)
+        self.output_fmt = output_fmt
+        self.quality = quality
+        self.renditions = renditions or None
+        if wm_obj is not None:
+            _watermark_token(wm_obj)
+            self._warm_watermark()
+
+    @classmethod
+    def from_preset(cls, preset: dict, font_dir: str, enabled: bool = True, mode: str = "Max Side",
+                    output_fmt: str = None, quality: int = None) -> "Pipeline":
+        """Пайплайн із пресета веб-додатку; output_fmt і quality перевизначають значення з пресета."""
+        output_fmt = output_fmt or preset.get('out_fmt', 'JPEG')
+        quality = quality or preset.get('out_quality', 80)
+        renditions = None
+        if preset.get('out_renditions'):
+            formats = [output_fmt] + [f for f in preset.get('out_extra_formats') or [] if f != output_fmt]
+            renditions = build_renditions(preset['out_renditions'], formats, quality)
+        return cls(watermark_from_preset(preset, font_dir), resize_config_from_preset(preset, enabled, mode),
+                   output_fmt, quality, renditions)
+
+    def _warm_watermark(self):
+        """Варіант лого для ширини, яку дасть більшість фото (Exact Width, Max Side для горизонтальних)."""
+        cfg = self.config
+        if not cfg['enabled'] or cfg['mode'] == 'Exact Height': return
+        opacity = _layer_opacities(cfg, _numpy_compositor(cfg))[0]
+        for r in self.renditions or [cfg]:
+            _watermark_layer((r['value'], r['value']), self.wm_obj, cfg, 1.0, opacity)
+
+    def filenames(self, file_path: str, naming_mode: str, prefix: str = "", index: int = 1) -> list:
+        """Імена результатів для одного фото: одне, або по одному на кожну версію."""
+        if self.renditions:
+            return [generate_filename(file_path, naming_mode, prefix, r['output_fmt'].lower(), index, r['suffix'])
+                    for r in self.renditions]
+        return [generate_filename(file_path, naming_mode, prefix, self.output_fmt.lower(), index)]
+
+    def render(self, file_path: str, filename: str, profile: bool = False) -> tuple:
+        """Як process_image: (байти, stats) без запису на диск."""
+        return _process_image(file_path, filename, self.wm_obj, self.config, self.output_fmt, self.quality, profile)
+
+    def preview(self, file_path: str, max_side: int = PREVIEW_MAX_SIDE) -> tuple:
+        return render_preview(file_path, self.wm_obj, self.config, self.output_fmt, max_side)
+
+    def run(self, file_path: str, out_path, profile: bool = False, result_cache: ResultCache = None):
+        """Один job на диск: out_path — шлях (або список шляхів для версій), повертає stats."""
+        return _run_job(file_path, out_path, self.wm_obj, self.config, self.output_fmt, self.quality,
+                        profile, self.renditions, result_cache)
+
+    def run_many(self, jobs: list, max_workers: int = 2, backend: str = "thread", profile: bool = False,
+                 result_cache: ResultCache = None, memory_budget: MemoryBudget = None,
+                 pool: WorkerPool = None, session: str = "default"):
+        """run_batch з налаштуваннями цього пайплайна; jobs — пари (file_path, out_path)."""
+        return run_batch(jobs, self.wm_obj, self.config, self.output_fmt, self.quality, max_workers, backend,
+                         profile, self.renditions, result_cache, memory_budget, pool, session)
@@ -0,0 +1,109 @@
+from PIL import Image
+
+"""
+Watermarker NumPy Kernels
+-------------------------
+Необов'язкове векторизоване накладання лого (resize_config['compositor'] = 'numpy').
+Прозорість лого, змішування та зведення на білий фон виконуються одним проходом
+по uint8-буферах лише в області під лого. Без NumPy AVAILABLE = False,
+і рушій лишається на шляху PIL.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AVAILABLE = np is not None
+
+# Рядків за один прохід: тимчасові uint16-буфери лишаються в межах кількох МБ навіть для 8K
+BAND_ROWS = 128
+
+def _div255(t):
+    """Точне округлене t / 255 для t < 65281 без ділення: (t + 128 + ((t + 128) >> 8)) >> 8."""
+    t += 128
+    t += t >> 8
+    t >>= 8
+    return t
+
+def _scaled_alpha(alpha, opacity: float):
+    a = alpha.astype(np.uint16)
+    if opacity < 1.0:
+        a *= int(round(opacity * 255))
+        a = _div255(a)
+    return a
+
+def _mix(dst, src_rgb, a):
+    """(src·a + dst·(255−a)) / 255 з округленням; сума не перевищує 255², тож усе вміщається в uint16."""
+    t = src_rgb.astype(np.uint16) * a
+    t += dst.astype(np.uint16) * (255 - a)
+    return _div255(t).astype(np.uint8)
+
+def _clip_box(frame_size: tuple, layer_size: tuple, pos: tuple) -> tuple:
+    x, y = pos
+    return x, y, min(x + layer_size[0], frame_size[0]), min(y + layer_size[1], frame_size[1])
+
+def _blend_rgb(frame: Image.Image, layer: Image.Image, pos: tuple, opacity: float) -> Image.Image:
+    box = _clip_box(frame.size, layer.size, pos)
+    region = np.array(frame.crop(box))
+    src = np.asarray(layer.crop((0, 0, box[2] - box[0], box[3] - box[1])))
+    for r in range(0, region.shape[0], BAND_ROWS):
+        s = src[r:r + BAND_ROWS]
+        a = _scaled_alpha(s[..., 3:4], opacity)
+        region[r:r + BAND_ROWS] = _mix(region[r:r + BAND_ROWS], s[..., :3], a)
+    frame.paste(Image.fromarray(region, "RGB"), box[:2])
+    return frame
+
+def _blend_rgba(frame: Image.Image, layer: Image.Image, pos: tuple, opacity: float) -> Image.Image:
+    """Оператор «over» для прозорого кадру (лише область під лого), як Image.alpha_composite."""
+    box = _clip_box(frame.size, layer.size, pos)
+    region = np.array(frame.crop(box))
+    src = np.asarray(layer.crop((0, 0, box[2] - box[0], box[3] - box[1])))
+    for r in range(0, region.shape[0], BAND_ROWS):
+        s = src[r:r + BAND_ROWS].astype(np.float32) / 255
+        d = region[r:r + BAND_ROWS].astype(np.float32) / 255
+        sa = s[..., 3:4] * opacity
+        da = d[..., 3:4] * (1 - sa)
+        out_a = sa + da
+        # Повністю прозорі пікселі зберігають свій колір, як у PIL
+        out_rgb = np.where(out_a > 0, (s[..., :3] * sa + d[..., :3] * da) / np.maximum(out_a, 1e-6), d[..., :3])
+        band = np.concatenate((out_rgb, out_a), axis=2)
+        region[r:r + BAND_ROWS] = (band * 255 + 0.5).astype(np.uint8)
+    frame.paste(Image.fromarray(region, "RGBA"), box[:2])
+    return frame
+
+def _blend_flatten(frame: Image.Image, layer: Image.Image, pos: tuple, opacity: float, background: tuple) -> Image.Image:
+    """
+    Прозорий кадр одразу на суцільний фон, і лого поверх — за один прохід по рядках.
+    «Over» асоціативний: лого поверх (кадр поверх фону) = (лого поверх кадру) поверх фону.
+    """
+    arr = np.asarray(frame)
+    out = np.empty(arr.shape[:2] + (3,), dtype=np.uint8)
+    bg = np.array(background, dtype=np.uint16)
+    x0, y0, x1, y1 = _clip_box(frame.size, layer.size, pos)
+    src = np.asarray(layer)
+    for r in range(0, arr.shape[0], BAND_ROWS):
+        band = arr[r:r + BAND_ROWS]
+        a = band[..., 3:4].astype(np.uint16)
+        t = band[..., :3].astype(np.uint16) * a
+        t += bg * (255 - a)
+        out[r:r + BAND_ROWS] = _div255(t)
+        # Частина смуги під лого
+        top, bottom = max(r, y0), min(r + band.shape[0], y1)
+        if top >= bottom or x0 >= x1: continue
+        s = src[top - y0:bottom - y0, :x1 - x0]
+        out[top:bottom, x0:x1] = _mix(out[top:bottom, x0:x1], s[..., :3], _scaled_alpha(s[..., 3:4], opacity))
+    return Image.fromarray(out, "RGB")
+
+def composite(frame: Image.Image, layer: Image.Image, pos: tuple, opacity: float = 1.0,
+              flatten: bool = False, background: tuple = (255, 255, 255)) -> Image.Image:
+    """
+    Накладає RGBA-шар layer на frame у позиції pos, множачи його альфу на opacity.
+    RGB-кадр змінюється на місці лише в області під шаром. RGBA-кадр з flatten=True
+    зводиться на background тим самим проходом і повертається новим RGB-зображенням.
+    Повертає результуючий кадр.
+    """
+    if frame.mode == "RGBA":
+        if flatten: return _blend_flatten(frame, layer, pos, opacity, background)
+        return _blend_rgba(frame, layer, pos, opacity)
+    return _blend_rgb(frame, layer, pos, opacity)
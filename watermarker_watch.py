@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+from datetime import datetime
+import watermarker_engine as engine
+from watermarker_cli import IMAGE_EXTENSIONS, FONT_DIR, format_size
+
+"""
+Watermarker Pro Hot Folder
+--------------------------
+Фоновий режим: стежить за текою, куди фотографи скидають знімки, і обробляє
+кожен новий файл пресетом у дзеркальне дерево результатів.
+
+    python watermarker_watch.py incoming/ -p wm_preset_full.wmpreset -o published/
+
+Файл береться в роботу, коли він перестав змінюватися (розмір і mtime стабільні
+settle секунд). Журнал у теці результатів пам'ятає оброблені файли за розміром
+і mtime, тож після перезапуску нічого не обробляється вдруге і нічого не пропускається.
+З inotify_simple (Linux) зміни будять цикл одразу, без нього — опитування.
+"""
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+JOURNAL_NAME = ".watermarker_journal.jsonl"
+# Тимчасові імена під час копіювання (rsync, браузери, офісні пакети) — не чіпати
+PARTIAL_SUFFIXES = ('.part', '.tmp', '.crdownload', '.partial', '~')
+# З inotify повне сканування лише як страховка (мережеві диски подій не шлють)
+INOTIFY_RESCAN_SECONDS = 30
+
+class Journal:
+    """
+    Append-only журнал (JSON Lines): один запис на завершену спробу обробки.
+    Кожен запис скидається на диск (fsync) до того, як файл вважається обробленим.
+    При відкритті журнал стискається до останнього запису на джерело.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # обірваний останній рядок після аварійної зупинки
+                    self.entries[entry['src']] = entry
+        self._compact()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _compact(self):
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def next_index(self) -> int:
+        """Наступний номер для іменування 'Prefix + Sequence' — стабільний між перезапусками."""
+        return max((e.get('index', 0) for e in self.entries.values()), default=0) + 1
+
+    def is_current(self, rel: str, signature: tuple) -> bool:
+        entry = self.entries.get(rel)
+        return entry is not None and (entry['size'], entry['mtime_ns']) == signature
+
+    def record(self, rel: str, signature: tuple, index: int, status: str, outputs: list = None, error: str = None):
+        entry = {'src': rel, 'size': signature[0], 'mtime_ns': signature[1], 'index': index, 'status': status,
+                 'outputs': outputs or [], 'time': datetime.now().isoformat(timespec='seconds')}
+        if error: entry['error'] = error
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.entries[rel] = entry
+
+    def close(self):
+        self._file.close()
+
+class _Waker:
+    """Очікування між скануваннями: події inotify будять раніше, інакше — простий sleep."""
+
+    def __init__(self, use_inotify: bool):
+        self._inotify = INotify() if use_inotify and INotify is not None else None
+        self._watched = set()
+        self.mode = "inotify" if self._inotify else "polling"
+
+    def watch(self, directory: str):
+        if self._inotify is None or directory in self._watched: return
+        mask = (inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+                | inotify_flags.MODIFY | inotify_flags.ATTRIB)
+        try:
+            self._inotify.add_watch(directory, mask)
+            self._watched.add(directory)
+        except OSError:
+            pass  # тека зникла або вичерпано ліміт watch — лишається опитування
+
+    def wait(self, seconds: float, stopping: list):
+        """Чекає до seconds; повертається раніше на подію або запит зупинки (перевірка щосекунди)."""
+        deadline = time.monotonic() + seconds
+        while not stopping:
+            left = deadline - time.monotonic()
+            if left <= 0: return
+            if self._inotify is None:
+                time.sleep(min(left, 1.0))
+            # read_delay збирає пачку подій від одного копіювання в одне пробудження
+            elif self._inotify.read(timeout=int(min(left, 1.0) * 1000), read_delay=50):
+                return
+
+def _is_candidate(name: str) -> bool:
+    if name.startswith('.') or name.endswith(PARTIAL_SUFFIXES): return False
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+def scan(input_dir: str, skip_dirs: set, recursive: bool, waker: _Waker) -> dict:
+    """Усі зображення теки: відносний шлях -> (size, mtime_ns)."""
+    found = {}
+    for root, dirs, names in os.walk(input_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and os.path.join(root, d) not in skip_dirs) if recursive else []
+        waker.watch(root)
+        for name in names:
+            if not _is_candidate(name): continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # файл прибрали між listdir і stat
+            found[os.path.relpath(path, input_dir)] = (st.st_size, st.st_mtime_ns)
+    return found
+
+class Settler:
+    """
+    Відсіює файли, які ще пишуться: файл готовий, коли його (size, mtime) однакові
+    у двох сканах поспіль і mtime старший за settle секунд. Порожні файли не готові.
+    """
+
+    def __init__(self, settle: float):
+        self.settle = settle
+        self._last = {}
+
+    def ready(self, found: dict) -> list:
+        now_ns = time.time_ns()
+        ready = []
+        for rel, signature in found.items():
+            stable = self._last.get(rel) == signature
+            if stable and signature[0] > 0 and now_ns - signature[1] >= self.settle * 1e9:
+                ready.append(rel)
+        self._last = found
+        return ready
+
+def _outputs_complete(src_path: str, out_paths: list) -> bool:
+    """Результати вже записані новіші за джерело — обробку перервали між записом і журналом."""
+    try:
+        src_mtime = os.stat(src_path).st_mtime
+        return all(os.stat(p).st_mtime >= src_mtime for p in out_paths)
+    except OSError:
+        return False
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Watermarker Pro: hot-folder watcher")
+    parser.add_argument('input', help="Тека, куди скидають фото")
+    parser.add_argument('-o', '--output', required=True, help="Тека для результатів (структура підтек зберігається)")
+    parser.add_argument('-p', '--preset', help="Пресет (.wmpreset або старий .json), збережений у веб-додатку")
+    parser.add_argument('-w', '--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Кількість потоків (за замовчуванням — половина ядер, щоб навантаження було рівним)")
+    parser.add_argument('--batch', type=int, help="Скільки готових файлів брати за один прохід (за замовчуванням 2×workers)")
+    parser.add_argument('--settle', type=float, default=2.0, help="Скільки секунд файл має не змінюватися, щоб вважатися дописаним")
+    parser.add_argument('--poll', type=float, default=1.0, help="Інтервал сканування, с")
+    parser.add_argument('--no-inotify', action='store_true', help="Лише опитування (мережеві диски)")
+    parser.add_argument('--no-recursive', action='store_true', help="Не заходити у вкладені теки")
+    parser.add_argument('--retry-failed', action='store_true', help="Повторити файли, що раніше завершилися помилкою")
+    parser.add_argument('--once', action='store_true', help="Обробити все, що вже дописано, і завершитися")
+    parser.add_argument('--format', choices=['JPEG', 'WEBP', 'PNG'], help="Перевизначити формат із пресету")
+    parser.add_argument('--quality', type=int, help="Перевизначити якість із пресету")
+    parser.add_argument('--size', type=int, help="Перевизначити розмір (px) із пресету")
+    parser.add_argument('--resize-mode', default='Max Side', choices=['Max Side', 'Exact Width', 'Exact Height'])
+    parser.add_argument('--no-resize', action='store_true', help="Не змінювати розмір")
+    parser.add_argument('--memory-budget-mb', type=int,
+                        help="Бюджет RAM для паралельних jobs, МБ (за замовчуванням — частка доступної; 0 — вимкнено)")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Лише помилки та підсумок")
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    try:
+        preset = engine.load_preset(args.preset) if args.preset else {}
+        if args.size: preset['resize_val'] = args.size
+        pipeline = engine.Pipeline.from_preset(preset, FONT_DIR, enabled=not args.no_resize, mode=args.resize_mode,
+                                               output_fmt=args.format, quality=args.quality)
+    except (OSError, ValueError) as e:
+        print(f"Settings error: {e}", file=sys.stderr)
+        return 2
+    naming_mode = preset.get('naming_mode', 'Keep Original')
+    prefix = preset.get('naming_prefix', '')
+    if not os.path.isdir(args.input):
+        print(f"Input folder not found: {args.input}", file=sys.stderr)
+        return 1
+
+    input_dir, output_dir = os.path.abspath(args.input), os.path.abspath(args.output)
+    os.makedirs(output_dir, exist_ok=True)
+    journal = Journal(os.path.join(output_dir, JOURNAL_NAME))
+    next_index = journal.next_index()
+    if args.retry_failed:
+        journal.entries = {rel: e for rel, e in journal.entries.items() if e['status'] != 'failed'}
+    # Хто вже займає кожне ім'я результату: однакові slug з різних джерел не перезаписують одне одного
+    owners = {out: e['src'] for e in journal.entries.values() for out in e['outputs']}
+
+    waker = _Waker(not args.no_inotify)
+    settler = Settler(args.settle)
+    batch_size = args.batch or args.workers * 2
+    budget_bytes = args.memory_budget_mb * 2**20 if args.memory_budget_mb else None
+
+    stopping = []
+    def request_stop(signum, frame): stopping.append(signum)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    if not args.quiet:
+        print(f"Watching {input_dir} -> {output_dir} ({waker.mode}, settle {args.settle:g}s); "
+              f"{args.workers} workers, {pipeline.output_fmt} q={pipeline.quality}; "
+              f"{len(journal.entries)} files in journal")
+
+    processed = failed = 0
+    orig_total = new_total = 0
+    try:
+        while not stopping:
+            found = scan(input_dir, {output_dir}, not args.no_recursive, waker)
+            todo = [rel for rel in found if not journal.is_current(rel, found[rel])]
+            ready = settler.ready({rel: found[rel] for rel in todo})
+            # Найстаріші першими: черга рухається в порядку появи файлів
+            ready.sort(key=lambda rel: (found[rel][1], rel))
+
+            jobs, meta = [], {}
+            for rel in ready[:batch_size]:
+                entry = journal.entries.get(rel)
+                index = entry['index'] if entry else next_index
+                if not entry: next_index += 1
+                src = os.path.join(input_dir, rel)
+                rel_outs = [os.path.join(os.path.dirname(rel), name)
+                            for name in pipeline.filenames(src, naming_mode, prefix, index)]
+                taken = [out for out in rel_outs if owners.get(out, rel) != rel]
+                if taken:
+                    journal.record(rel, found[rel], index, 'failed', error=f"output name {taken[0]} already taken")
+                    print(f"FAILED {rel}: output name {taken[0]} already taken", file=sys.stderr)
+                    failed += 1
+                    continue
+                out_paths = [os.path.join(output_dir, out) for out in rel_outs]
+                if entry is None and _outputs_complete(src, out_paths):
+                    journal.record(rel, found[rel], index, 'done', rel_outs)
+                    owners.update((out, rel) for out in rel_outs)
+                    if not args.quiet: print(f"{datetime.now():%H:%M:%S} {rel}: outputs already written, journaled")
+                    continue
+                for path in out_paths: os.makedirs(os.path.dirname(path), exist_ok=True)
+                owners.update((out, rel) for out in rel_outs)
+                jobs.append((src, out_paths if pipeline.renditions else out_paths[0]))
+                meta[src] = (rel, index, rel_outs)
+
+            if jobs:
+                # Бюджет на прохід: журнал рішень MemoryBudget не росте весь час роботи демона
+                memory_budget = engine.MemoryBudget(budget_bytes) if args.memory_budget_mb != 0 else None
+                for src, stats, err in pipeline.run_many(jobs, args.workers, memory_budget=memory_budget):
+                    rel, index, rel_outs = meta[src]
+                    if err is None:
+                        journal.record(rel, found[rel], index, 'done', rel_outs)
+                        processed += 1
+                        items = stats if pipeline.renditions else [stats]
+                        orig_total += items[0]['orig_size']
+                        new_total += sum(s['new_size'] for s in items)
+                        if not args.quiet:
+                            print(f"{datetime.now():%H:%M:%S} {rel} -> {', '.join(rel_outs)} "
+                                  f"{items[0]['orig_res']} -> {items[0]['new_res']}, "
+                                  f"{format_size(items[0]['orig_size'])} -> {format_size(sum(s['new_size'] for s in items))}, "
+                                  f"{sum(s['elapsed_ms'] for s in items):.0f} ms")
+                    else:
+                        journal.record(rel, found[rel], index, 'failed', error=str(err))
+                        print(f"{datetime.now():%H:%M:%S} FAILED {rel}: {err}", file=sys.stderr)
+                        failed += 1
+                continue  # одразу наступний прохід: могли з'явитися нові готові файли
+
+            # Порожні файли можуть так і лишитися порожніми — --once на них не чекає
+            writing = [rel for rel in todo if found[rel][0] > 0]
+            if args.once and not writing: break
+            # Поки щось дописується — звичайний інтервал; у тиші з inotify спимо довше
+            busy = writing or waker.mode == "polling"
+            waker.wait(args.poll if busy else INOTIFY_RESCAN_SECONDS, stopping)
+    finally:
+        journal.close()
+
+    print("--- Summary ---")
+    print(f"Processed: {processed}  Failed: {failed}"
+          + (f"  Size: {format_size(orig_total)} -> {format_size(new_total)}" if processed else ""))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,15 @@
 import streamlit as st
 import pandas as pd
-import io
 import os
 import shutil
 import tempfile
 import zipfile
-import concurrent.futures
-import gc
 import json
+import uuid
 from datetime import datetime
-from PIL import Image
 import watermarker_engine as engine
 import glob
+import fnmatch
 
 # --- КОНФІГУРАЦІЯ ---
 st.set_page_config(page_title="Watermarker Pro v5.5", page_icon="📸", layout="wide")
@@ -29,6 +27,10 @@ DEFAULT_SETTINGS = {
     # New defaults
     'out_fmt': 'JPEG',
     'out_quality': 80,
+    'out_profile': engine.DEFAULT_ENCODER_PROFILE,
+    'out_target_kb': 0,
+    'out_renditions': [],
+    'out_extra_formats': [],
     'naming_mode': 'Keep Original',
     'naming_prefix': '',
     'font_name': None,
@@ -46,7 +48,7 @@ TRANSLATIONS = {
         "btn_defaults": "↺ Скинути налаштування",
         
         "sec_presets": "💾 Менеджер пресетів",
-        "lbl_load_preset": "Завантажити пресет (.json)",
+        "lbl_load_preset": "Завантажити пресет (.wmpreset / .json)",
         "btn_save_preset": "⬇️ Зберегти повний пресет",
         "msg_preset_loaded": "✅ Пресет завантажено (лого, шрифти, налаштування)!",
         "error_preset": "❌ Помилка пресету: {}",
@@ -54,6 +56,16 @@ TRANSLATIONS = {
         "sec_file": "1. Файл та Ім'я",
         "lbl_format": "Формат виводу",
         "lbl_quality": "Якість (%)",
+        "lbl_profile": "Профіль енкодера",
+        "help_profile": "fast — швидкі проби, balanced — золота середина (WEBP/PNG значно швидше, файли дещо більші), smallest — найменші файли для вебу (найповільніше), classic — як у попередніх версіях (за замовчуванням).",
+        "lbl_target_kb": "Цільовий розмір (KB)",
+        "lbl_renditions": "Набір версій",
+        "help_renditions": "Кожне фото декодується один раз і зберігається в усіх вибраних розмірах (суфікс _hd/_fhd/_4k). Замінює налаштування розміру.",
+        "lbl_extra_formats": "Додаткові формати",
+        "caption_target_q": "Підібрана якість: {} ({})",
+        "target_met": "вкладено в ліміт",
+        "target_missed": "ліміт недосяжний",
+        "help_target_kb": "0 — вимкнено. Інакше якість підбирається для кожного фото, щоб файл вклався в ліміт (повзунок якості — верхня межа).",
         "lbl_naming": "Іменування файлів",
         "lbl_prefix": "Префікс файлу",
         
@@ -81,26 +93,53 @@ TRANSLATIONS = {
         
         "sec_perf": "⚙️ Продуктивність",
         "lbl_threads": "Потоки (Threads)",
-        "help_threads": "Зменшіть це число, якщо програма вилітає з помилкою.",
+        "help_threads": "Скільки фото цього батчу обробляється одночасно. Загальну кількість для всіх користувачів обмежує спільний пул (за ядрами CPU); одне місце завжди лишається для прев'ю.",
+        "lbl_pool_stats": "Спільний пул: зайнято {}/{} · у черзі {} пакетних, {} інтерактивних · очікування ~{:.0f} мс",
+        "lbl_backend": "Режим виконання",
+        "opt_backend_thread": "Потоки",
+        "opt_backend_process": "Процеси",
+        "help_backend": "Обидва режими працюють у межах спільного для всіх сесій пулу. Процеси обходять GIL, але мають довший старт.",
+        "lbl_mem_budget": "Бюджет RAM (МБ)",
+        "help_mem_budget": "Фото запускаються паралельно, лише доки їхня оцінка пам'яті вміщається в бюджет: великі панорами йдуть по одній, малі — широко. 0 — без обмеження.",
+        "lbl_mem_summary": "Бюджет {:.0f} МБ · пік {:.0f} МБ ({} одночасно) · притримано {} · поодинці {}",
+        "chk_result_cache": "Кеш результатів",
+        "help_result_cache": "Не перераховує фото з тими самими налаштуваннями (зокрема після зміни лише імен файлів). Спільний для всіх сесій.",
+        "lbl_cache_stats": "У кеші: {} файлів, {:.0f} МБ · влучань {:.0%}",
+        "btn_clear_cache": "Очистити кеш",
         
         "files_header": "📂 Робоча область", 
         "uploader_label": "Завантажити фото",
+        "msg_duplicates": "Пропущено дублікатів: {} (такий самий вміст уже завантажено).",
+        "error_upload": "❌ {}: не вдалося прочитати зображення ({})",
         "btn_process": "🚀 Обробити", 
         "msg_done": "Готово!",
         "error_wm_load": "❌ Помилка: {}",
+        "error_settings": "❌ Некоректні налаштування: {}. Виправте їх або натисніть «{}» у бічній панелі.",
         "btn_dl_zip": "📦 Скачати ZIP",
         "exp_dl_separate": "⬇️ Скачати окремо",
+        "exp_report": "📊 Звіт обробки",
+        "lbl_report_stages": "Час за етапами (мс)",
         
         "prev_header": "👁️ Живий перегляд",
         "prev_placeholder": "Оберіть файл (✅) для перегляду",
         "stat_res": "Роздільна здатність",
         "stat_size": "Розмір файлу",
+        "btn_exact_size": "📏 Точна вага",
+        "help_exact_size": "Повний рендер з фінальним енкодером",
         
         "grid_select_all": "✅ Всі",
         "grid_deselect_all": "⬜ Жодного",
         "grid_delete": "🗑️ Видалити",
         "btn_selected": "✅ Обрано",
         "btn_select": "⬜ Обрати",
+        "exp_filter": "🔎 Фільтр",
+        "lbl_filter_name": "Ім'я (текст або шаблон *.png)",
+        "lbl_filter_min_side": "Мін. довша сторона (px)",
+        "lbl_filter_max_mb": "Макс. розмір файлу (МБ, 0 — без обмеження)",
+        "help_filter": "«Всі» / «Жодного» діють лише на файли, що пройшли фільтр.",
+        "lbl_page_size": "На сторінці",
+        "lbl_page": "Сторінка {} з {}",
+        "grid_stats": "Файлів: {} · за фільтром: {} · обрано: {}",
         "warn_no_files": "⚠️ Спочатку оберіть файли!",
         "btn_clear_workspace": "♻️ Очистити все",
         "expander_add_files": "📤 Додати файли (Drag & Drop)",
@@ -121,7 +160,7 @@ TRANSLATIONS = {
         "btn_defaults": "↺ Reset",
         
         "sec_presets": "💾 Presets Manager",
-        "lbl_load_preset": "Load Preset (.json)",
+        "lbl_load_preset": "Load Preset (.wmpreset / .json)",
         "btn_save_preset": "⬇️ Save Full Preset",
         "msg_preset_loaded": "✅ Preset loaded (logo, fonts, settings included)!",
         "error_preset": "❌ Preset error: {}",
@@ -129,6 +168,16 @@ TRANSLATIONS = {
         "sec_file": "1. File & Naming",
         "lbl_format": "Output Format",
         "lbl_quality": "Quality (%)",
+        "lbl_profile": "Encoder Profile",
+        "help_profile": "fast for proofing, balanced for everyday use (much faster WEBP/PNG, somewhat larger files), smallest for final web delivery (slowest), classic matches earlier versions (default).",
+        "lbl_target_kb": "Target Size (KB)",
+        "lbl_renditions": "Rendition Set",
+        "help_renditions": "Each photo is decoded once and saved at every selected size (_hd/_fhd/_4k suffix). Overrides the resize settings.",
+        "lbl_extra_formats": "Extra Formats",
+        "caption_target_q": "Chosen quality: {} ({})",
+        "target_met": "within the limit",
+        "target_missed": "limit unreachable",
+        "help_target_kb": "0 disables it. Otherwise quality is picked per photo so the file fits the limit (the quality slider is the upper bound).",
         "lbl_naming": "Naming",
         "lbl_prefix": "Prefix",
         
@@ -156,26 +205,53 @@ TRANSLATIONS = {
         
         "sec_perf": "⚙️ Performance",
         "lbl_threads": "Max Threads",
-        "help_threads": "Reduce this number if the app crashes.",
+        "help_threads": "How many photos of this batch run at once. The shared pool caps the total across all users at the CPU core count and always keeps one slot free for previews.",
+        "lbl_pool_stats": "Shared pool: {}/{} busy · queued {} bulk, {} interactive · wait ~{:.0f} ms",
+        "lbl_backend": "Execution Backend",
+        "opt_backend_thread": "Threads",
+        "opt_backend_process": "Processes",
+        "help_backend": "Both modes run within the pool shared by all sessions. Processes sidestep the GIL but take longer to start.",
+        "lbl_mem_budget": "RAM Budget (MB)",
+        "help_mem_budget": "Photos run in parallel only while their estimated memory fits the budget: large panoramas run one at a time, small photos run wide. 0 disables it.",
+        "lbl_mem_summary": "Budget {:.0f} MB · peak {:.0f} MB ({} at once) · held back {} · ran alone {}",
+        "chk_result_cache": "Result Cache",
+        "help_result_cache": "Skips photos already processed with the same settings (including when only file names change). Shared by all sessions.",
+        "lbl_cache_stats": "Cached: {} files, {:.0f} MB · hit rate {:.0%}",
+        "btn_clear_cache": "Clear Cache",
         
         "files_header": "📂 Workspace", 
         "uploader_label": "Upload Photos",
+        "msg_duplicates": "Skipped {} duplicate(s): the same content is already uploaded.",
+        "error_upload": "❌ {}: could not read the image ({})",
         "btn_process": "🚀 Process", 
         "msg_done": "Done!",
         "error_wm_load": "❌ Error: {}",
+        "error_settings": "❌ Invalid settings: {}. Fix them or press “{}” in the sidebar.",
         "btn_dl_zip": "📦 Download ZIP",
         "exp_dl_separate": "⬇️ Download Separate",
+        "exp_report": "📊 Processing Report",
+        "lbl_report_stages": "Time per stage (ms)",
         
         "prev_header": "👁️ Live Preview",
         "prev_placeholder": "Select a file (✅) to preview",
         "stat_res": "Resolution",
         "stat_size": "File Size",
+        "btn_exact_size": "📏 Exact Size",
+        "help_exact_size": "Full render with the final encoder",
         
         "grid_select_all": "✅ All",
         "grid_deselect_all": "⬜ None",
         "grid_delete": "🗑️ Delete",
         "btn_selected": "✅ Selected",
         "btn_select": "⬜ Select",
+        "exp_filter": "🔎 Filter",
+        "lbl_filter_name": "Name (text or pattern like *.png)",
+        "lbl_filter_min_side": "Min. long side (px)",
+        "lbl_filter_max_mb": "Max. file size (MB, 0 = no limit)",
+        "help_filter": "All / None apply only to files that pass the filter.",
+        "lbl_page_size": "Per page",
+        "lbl_page": "Page {} of {}",
+        "grid_stats": "Files: {} · filtered: {} · selected: {}",
         "warn_no_files": "⚠️ Select files first!",
         "btn_clear_workspace": "♻️ Clear Workspace",
         "expander_add_files": "📤 Add Files (Drag & Drop)",
@@ -218,23 +294,64 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --- RESULT CACHE ---
+@st.cache_resource
+def get_result_cache():
+    # Один кеш на процес сервера: спільний для сесій і перезапусків скрипта
+    return engine.ResultCache(os.path.join(tempfile.gettempdir(), "wm_pro_result_cache"))
+
 # --- SESSION STATE ---
 if 'temp_dir' not in st.session_state: st.session_state['temp_dir'] = tempfile.mkdtemp(prefix="wm_pro_")
+if 'session_id' not in st.session_state: st.session_state['session_id'] = uuid.uuid4().hex
 if 'file_cache' not in st.session_state: st.session_state['file_cache'] = {} 
+if 'ingest_index' not in st.session_state: st.session_state['ingest_index'] = {}
 if 'selected_files' not in st.session_state: st.session_state['selected_files'] = set()
 if 'uploader_key' not in st.session_state: st.session_state['uploader_key'] = 0
 if 'lang_code' not in st.session_state: st.session_state['lang_code'] = 'ua'
+# Доступна RAM змінюється між викликами, тож бюджет за замовчуванням рахується раз на сесію
+if 'mem_budget_key' not in st.session_state: st.session_state['mem_budget_key'] = engine.default_memory_budget() // 2**20
 
 # --- HELPERS ---
+def read_file(path):
+    with open(path, "rb") as f: return f.read()
+
 def save_uploaded_file(uploaded_file):
-    temp_dir = st.session_state['temp_dir']
-    file_path = os.path.join(temp_dir, uploaded_file.name)
-    if os.path.exists(file_path):
-        base, ext = os.path.splitext(uploaded_file.name)
-        timestamp = datetime.now().strftime("%H%M%S")
-        file_path = os.path.join(temp_dir, f"{base}_{timestamp}{ext}")
-    with open(file_path, "wb") as f: f.write(uploaded_file.getbuffer())
-    return file_path, os.path.basename(file_path)
+    # Потокове збереження з хешем: однаковий вміст зберігається й обробляється один раз
+    return engine.ingest_upload(uploaded_file, uploaded_file.name, st.session_state['temp_dir'], st.session_state['ingest_index'])
+
+def filter_files(names, records, pattern, min_side, max_mb):
+    """Імена файлів, що відповідають фільтру; розміри беруться з індексу завантажень, без звернень до диска."""
+    pattern = pattern.strip().lower()
+    result = []
+    for name in names:
+        if pattern:
+            if any(ch in pattern for ch in "*?["):
+                if not fnmatch.fnmatch(name.lower(), pattern): continue
+            elif pattern not in name.lower(): continue
+        rec = records.get(name)
+        if rec:
+            if min_side and max(rec['width'], rec['height']) < min_side: continue
+            if max_mb and rec['size'] > max_mb * 1024 * 1024: continue
+        result.append(name)
+    return result
+
+# Колбеки галереї: змінюють стан до перезапуску скрипта, тож st.rerun() не потрібен
+def toggle_selected(fname):
+    sel = st.session_state['selected_files']
+    if fname in sel: sel.remove(fname)
+    else: sel.add(fname)
+
+def select_files(names, selected):
+    if selected: st.session_state['selected_files'].update(names)
+    else: st.session_state['selected_files'].difference_update(names)
+
+def delete_selected():
+    for fname in st.session_state['selected_files']:
+        st.session_state['file_cache'].pop(fname, None)
+    st.session_state['selected_files'] = set()
+
+def set_gallery_page(page):
+    st.session_state['gallery_page'] = page
 
 def get_available_fonts():
     font_dir = os.path.join(os.getcwd(), 'assets', 'fonts')
@@ -272,21 +389,18 @@ def reset_settings():
     
     st.session_state['out_fmt_key'] = DEFAULT_SETTINGS['out_fmt']
     st.session_state['out_quality_key'] = DEFAULT_SETTINGS['out_quality']
+    st.session_state['out_profile_key'] = DEFAULT_SETTINGS['out_profile']
+    st.session_state['out_target_kb_key'] = DEFAULT_SETTINGS['out_target_kb']
+    st.session_state['out_renditions_key'] = DEFAULT_SETTINGS['out_renditions']
+    st.session_state['out_extra_formats_key'] = DEFAULT_SETTINGS['out_extra_formats']
     st.session_state['naming_mode_key'] = DEFAULT_SETTINGS['naming_mode']
     st.session_state['naming_prefix_key'] = DEFAULT_SETTINGS['naming_prefix']
     st.session_state['font_name_key'] = DEFAULT_SETTINGS['font_name']
     st.session_state['preset_wm_bytes_key'] = None # Clear loaded logo
+    st.session_state['preset_wm_hash_key'] = None
 
-def get_current_settings_json(uploaded_wm_file):
-    """Збирає всі налаштування + картинку лого в JSON."""
-    
-    # Спроба отримати байти логотипу: або з завантаження, або з кешу
-    wm_b64 = None
-    if uploaded_wm_file:
-        wm_b64 = engine.image_to_base64(uploaded_wm_file.getvalue())
-    elif st.session_state.get('preset_wm_bytes_key'):
-        wm_b64 = engine.image_to_base64(st.session_state['preset_wm_bytes_key'])
-        
+def get_current_settings():
+    """Збирає всі налаштування (без лого) — дешево, тож можна на кожен rerun."""
     settings = {
         # Geometry
         'resize_val': st.session_state.get('resize_val_state', 1920),
@@ -307,18 +421,31 @@ def get_current_settings_json(uploaded_wm_file):
         # Files (Added in v5.5)
         'out_fmt': st.session_state.get('out_fmt_key', 'JPEG'),
         'out_quality': st.session_state.get('out_quality_key', 80),
+        'out_profile': st.session_state.get('out_profile_key', engine.DEFAULT_ENCODER_PROFILE),
+        'out_target_kb': st.session_state.get('out_target_kb_key', 0),
+        'out_renditions': st.session_state.get('out_renditions_key', []),
+        'out_extra_formats': st.session_state.get('out_extra_formats_key', []),
         'naming_mode': st.session_state.get('naming_mode_key', 'Keep Original'),
         'naming_prefix': st.session_state.get('naming_prefix_key', ''),
-        
-        # Logo File (Base64)
-        'wm_image_b64': wm_b64
     }
-    return json.dumps(settings, indent=4)
+    return settings
 
-def apply_settings_from_json(json_data):
-    """Завантажує налаштування і картинку в Session State."""
+def preset_bundle_data(uploaded_wm_file):
+    """
+    Колбек для кнопки збереження: бандл пакується лише після натискання, а не на кожен rerun.
+    Лого — або з завантаження, або з пресету.
+    """
+    settings = get_current_settings()
+    preset_bytes = st.session_state.get('preset_wm_bytes_key')
+    def build():
+        wm_bytes = uploaded_wm_file.getvalue() if uploaded_wm_file else preset_bytes
+        return engine.dump_preset_bundle(settings, wm_bytes)
+    return build
+
+def apply_settings_from_preset(preset_file):
+    """Завантажує налаштування і картинку в Session State (бандл або старий .json)."""
     try:
-        data = json.load(json_data)
+        data = engine.parse_preset(preset_file.getvalue())
         
         # Basic
         if 'resize_val' in data: st.session_state['resize_val_state'] = data['resize_val']
@@ -337,15 +464,16 @@ def apply_settings_from_json(json_data):
         # Files
         if 'out_fmt' in data: st.session_state['out_fmt_key'] = data['out_fmt']
         if 'out_quality' in data: st.session_state['out_quality_key'] = data['out_quality']
+        if 'out_profile' in data: st.session_state['out_profile_key'] = data['out_profile']
+        if 'out_target_kb' in data: st.session_state['out_target_kb_key'] = data['out_target_kb']
+        if 'out_renditions' in data: st.session_state['out_renditions_key'] = data['out_renditions']
+        if 'out_extra_formats' in data: st.session_state['out_extra_formats_key'] = data['out_extra_formats']
         if 'naming_mode' in data: st.session_state['naming_mode_key'] = data['naming_mode']
         if 'naming_prefix' in data: st.session_state['naming_prefix_key'] = data['naming_prefix']
         
-        # Decode Logo
-        if 'wm_image_b64' in data and data['wm_image_b64']:
-            img_bytes = engine.base64_to_bytes(data['wm_image_b64'])
-            st.session_state['preset_wm_bytes_key'] = img_bytes
-        else:
-            st.session_state['preset_wm_bytes_key'] = None
+        # Logo: сирі байти + хеш; декодування — лише через кеш рушія
+        st.session_state['preset_wm_bytes_key'] = data.get('wm_image_bytes')
+        st.session_state['preset_wm_hash_key'] = data.get('wm_image_hash')
             
         return True
     except Exception as e:
@@ -360,11 +488,11 @@ with st.sidebar:
     
     # --- PRESETS ---
     with st.expander(T['sec_presets'], expanded=False):
-        uploaded_preset = st.file_uploader(T['lbl_load_preset'], type=['json'], key='preset_uploader')
+        uploaded_preset = st.file_uploader(T['lbl_load_preset'], type=[engine.PRESET_BUNDLE_EXT[1:], 'json'], key='preset_uploader')
         if uploaded_preset is not None:
             # Check if processed in this run to avoid infinite loop
             if f"processed_{uploaded_preset.name}" not in st.session_state:
-                res = apply_settings_from_json(uploaded_preset)
+                res = apply_settings_from_preset(uploaded_preset)
                 if res is True:
                     st.session_state[f"processed_{uploaded_preset.name}"] = True
                     st.success(T['msg_preset_loaded'])
@@ -375,13 +503,12 @@ with st.sidebar:
         st.divider()
         # Pass the current file uploader object to save its content
         current_wm_file = st.session_state.get('wm_uploader_obj') 
-        json_str = get_current_settings_json(current_wm_file)
         
         st.download_button(
             label=T['btn_save_preset'],
-            data=json_str,
-            file_name="wm_preset_full.json",
-            mime="application/json",
+            data=preset_bundle_data(current_wm_file),
+            file_name=f"wm_preset_full{engine.PRESET_BUNDLE_EXT}",
+            mime="application/zip",
             use_container_width=True
         )
 
@@ -389,8 +516,15 @@ with st.sidebar:
         # Bind keys to session state
         out_fmt = st.selectbox(T['lbl_format'], ["JPEG", "WEBP", "PNG"], key='out_fmt_key')
         quality = 80
+        target_kb = 0
         if out_fmt != "PNG": 
             quality = st.slider(T['lbl_quality'], 50, 100, 80, 5, key='out_quality_key')
+            target_kb = st.number_input(T['lbl_target_kb'], 0, 50000, 0, 50, key='out_target_kb_key', help=T['help_target_kb'])
+        out_profile = st.selectbox(T['lbl_profile'], list(engine.ENCODER_PROFILES), key='out_profile_key', help=T['help_profile'])
+        out_renditions = st.multiselect(T['lbl_renditions'], list(engine.RENDITION_SIZES), key='out_renditions_key', help=T['help_renditions'])
+        extra_formats = []
+        if out_renditions:
+            extra_formats = st.multiselect(T['lbl_extra_formats'], ["JPEG", "WEBP", "PNG"], key='out_extra_formats_key')
         naming_mode = st.selectbox(T['lbl_naming'], ["Keep Original", "Prefix + Sequence"], key='naming_mode_key')
         prefix = st.text_input(T['lbl_prefix'], placeholder="img", key='naming_prefix_key')
 
@@ -420,8 +554,7 @@ with st.sidebar:
                 st.info(T['msg_preset_logo_active'])
                 # Preview preset logo
                 try:
-                    p_img = Image.open(io.BytesIO(st.session_state['preset_wm_bytes_key']))
-                    st.image(p_img, width=150)
+                    st.image(st.session_state['preset_wm_bytes_key'], width=150)
                 except: pass
 
         with tab2:
@@ -455,7 +588,19 @@ with st.sidebar:
         wm_angle = st.slider(T['lbl_angle'], -180, 180, key='wm_angle_key')
 
     with st.expander(T['sec_perf'], expanded=False):
-        max_threads = st.slider(T['lbl_threads'], 1, 8, 2, help=T['help_threads'])
+        exec_backend = st.radio(T['lbl_backend'], engine.BACKENDS, horizontal=True, help=T['help_backend'],
+                                format_func=lambda b: T[f'opt_backend_{b}'])
+        max_threads = st.slider(T['lbl_threads'], 1, max(8, os.cpu_count() or 1), min(8, os.cpu_count() or 2), help=T['help_threads'])
+        pool_stats = engine.get_worker_pool().stats()
+        st.caption(T['lbl_pool_stats'].format(pool_stats['running'], pool_stats['workers'], pool_stats['queued_bulk'],
+                                              pool_stats['queued_interactive'], pool_stats['wait_ms_bulk']))
+        mem_budget_mb = st.number_input(T['lbl_mem_budget'], 0, 1024 * 1024, step=256, key='mem_budget_key',
+                                        help=T['help_mem_budget'])
+        use_cache = st.checkbox(T['chk_result_cache'], value=True, help=T['help_result_cache'])
+        if use_cache:
+            cache_stats = get_result_cache().stats()
+            st.caption(T['lbl_cache_stats'].format(cache_stats['entries'], cache_stats['bytes'] / 2**20, cache_stats['hit_rate']))
+            st.button(T['btn_clear_cache'], on_click=lambda: get_result_cache().clear(), use_container_width=True)
 
     st.divider()
     if st.button(T['btn_defaults'], on_click=reset_settings, use_container_width=True): st.rerun()
@@ -482,6 +627,45 @@ with st.sidebar:
                 st.session_state['lang_code'] = 'en'; st.rerun()
 
 st.title(T['title'])
+# --- PIPELINE ---
+# Знак і налаштування збираються один раз на rerun; батч і прев'ю беруть той самий Pipeline
+wm_obj, wm_sig, wm_error = None, None, None
+try:
+    if wm_text.strip():
+        font_path = None
+        if selected_font_name:
+            font_path = os.path.join(os.getcwd(), 'assets', 'fonts', selected_font_name)
+        wm_obj = engine.create_text_watermark(wm_text, font_path, 100, wm_text_color)
+        wm_sig = [wm_text, selected_font_name, wm_text_color]
+    else:
+        # Image Mode: Check Upload -> Check Preset
+        wm_bytes, wm_hash = None, None
+        if wm_file: wm_bytes = wm_file.getvalue()
+        elif st.session_state.get('preset_wm_bytes_key'):
+            wm_bytes, wm_hash = st.session_state['preset_wm_bytes_key'], st.session_state.get('preset_wm_hash_key')
+        
+        if wm_bytes:
+            wm_sig = wm_hash or engine.logo_digest(wm_bytes)
+            wm_obj = engine.load_watermark_cached(wm_bytes, wm_sig)
+except Exception as e:
+    wm_obj, wm_sig, wm_error = None, None, e
+
+resize_cfg = {
+    'enabled': resize_on, 'mode': resize_mode, 'value': resize_val,
+    'wm_scale': wm_scale, 'wm_margin': wm_margin, 'wm_gap': wm_gap,
+    'wm_position': wm_pos, 'wm_angle': wm_angle, 'wm_opacity': wm_opacity,
+    'encoder_profile': out_profile, 'target_size_kb': target_kb
+}
+renditions = None
+if out_renditions:
+    renditions = engine.build_renditions(out_renditions, [out_fmt] + [f for f in extra_formats if f != out_fmt], quality)
+try:
+    pipeline = engine.Pipeline(wm_obj, resize_cfg, out_fmt, quality, renditions)
+except ValueError as e:
+    # Напр. пресет з невідомою позицією чи профілем: сайдбар уже намальовано, там можна виправити
+    st.error(T['error_settings'].format(e, T['btn_defaults']))
+    st.stop()
+
 c_left, c_right = st.columns([1.8, 1], gap="large")
 
 with c_left:
@@ -491,6 +675,7 @@ with c_left:
     with col_clear:
         if st.button(T['btn_clear_workspace'], type="secondary", use_container_width=True):
             st.session_state['file_cache'] = {}
+            st.session_state['ingest_index'] = {}
             st.session_state['selected_files'] = set()
             st.session_state['uploader_key'] += 1
             st.session_state['results'] = None
@@ -501,42 +686,66 @@ with c_left:
     
     has_files = len(st.session_state['file_cache']) > 0
     with st.expander(T['expander_add_files'], expanded=not has_files):
-        uploaded = st.file_uploader(T['uploader_label'], type=['jpg','jpeg','png','webp'], accept_multiple_files=True, label_visibility="collapsed", key=f"up_{st.session_state['uploader_key']}")
+        uploaded = st.file_uploader(T['uploader_label'], type=['jpg','jpeg','png','webp','tif','tiff'], accept_multiple_files=True, label_visibility="collapsed", key=f"up_{st.session_state['uploader_key']}")
     
     if uploaded:
+        new_paths = []
+        duplicates = 0
+        errors = []
         for f in uploaded:
-            fpath, fname = save_uploaded_file(f)
-            st.session_state['file_cache'][fname] = fpath
+            try:
+                record = save_uploaded_file(f)
+            except OSError as e:
+                errors.append(T['error_upload'].format(f.name, e))
+                continue
+            if record['duplicate']: duplicates += 1
+            else: new_paths.append(record['path'])
+            st.session_state['file_cache'][record['name']] = record['path']
+        # Мініатюри генеруються паралельно у фоні, сітка лише забирає готові
+        engine.prefetch_thumbnails(new_paths, session=st.session_state['session_id'])
+        if duplicates: st.session_state['upload_notice'] = T['msg_duplicates'].format(duplicates)
+        # Як і upload_notice: переживає st.rerun() нижче і показується один раз
+        if errors: st.session_state['upload_errors'] = errors
         st.session_state['uploader_key'] += 1
         st.rerun()
+    if st.session_state.get('upload_notice'):
+        st.info(st.session_state.pop('upload_notice'))
+    for message in st.session_state.pop('upload_errors', []):
+        st.error(message)
 
     files_map = st.session_state['file_cache']
     files_names = list(files_map.keys())
 
     if files_names:
+        records = {r['name']: r for r in st.session_state['ingest_index'].values()}
+        with st.expander(T['exp_filter']):
+            f1, f2, f3 = st.columns([2, 1, 1])
+            name_filter = f1.text_input(T['lbl_filter_name'], key='filter_name_key', on_change=set_gallery_page, args=(0,), help=T['help_filter'])
+            min_side = f2.number_input(T['lbl_filter_min_side'], 0, 100000, 0, 100, key='filter_min_side_key', on_change=set_gallery_page, args=(0,))
+            max_mb = f3.number_input(T['lbl_filter_max_mb'], 0.0, 10000.0, 0.0, 0.5, key='filter_max_mb_key', on_change=set_gallery_page, args=(0,))
+        visible_names = filter_files(files_names, records, name_filter, min_side, max_mb)
+
         act1, act2, act3 = st.columns([1, 1, 1])
         with act1:
-            if st.button(T['grid_select_all'], use_container_width=True):
-                st.session_state['selected_files'] = set(files_names)
-                st.rerun()
+            st.button(T['grid_select_all'], use_container_width=True, on_click=select_files, args=(visible_names, True))
         with act2:
-            if st.button(T['grid_deselect_all'], use_container_width=True):
-                st.session_state['selected_files'].clear()
-                st.rerun()
+            st.button(T['grid_deselect_all'], use_container_width=True, on_click=select_files, args=(visible_names, False))
         with act3:
             sel_count = len(st.session_state['selected_files'])
-            if st.button(f"{T['grid_delete']} ({sel_count})", type="primary", use_container_width=True, disabled=sel_count==0):
-                for f in list(st.session_state['selected_files']):
-                    if f in files_map: del files_map[f]
-                st.session_state['selected_files'].clear()
-                st.rerun()
+            st.button(f"{T['grid_delete']} ({sel_count})", type="primary", use_container_width=True, disabled=sel_count==0,
+                      on_click=delete_selected)
         
         st.divider()
         
+        # Віджети й мініатюри — лише для поточної сторінки: вартість перемальовування не залежить від кількості файлів
         cols_count = 4
-        cols = st.columns(cols_count)
+        page_size = st.session_state.get('gallery_page_size_key', 24)
+        pages = max(1, -(-len(visible_names) // page_size))
+        page = min(st.session_state.get('gallery_page', 0), pages - 1)
+        page_names = visible_names[page * page_size:(page + 1) * page_size]
         
-        for i, fname in enumerate(files_names):
+        cols = st.columns(cols_count)
+        for i, fname in enumerate(page_names):
             col = cols[i % cols_count]
             fpath = files_map[fname]
             with col:
@@ -545,12 +754,21 @@ with c_left:
                 else: st.warning("Error")
                 
                 is_sel = fname in st.session_state['selected_files']
-                if st.button(T['btn_selected'] if is_sel else T['btn_select'], key=f"btn_{fname}", type="primary" if is_sel else "secondary", use_container_width=True):
-                    if is_sel: st.session_state['selected_files'].remove(fname)
-                    else: st.session_state['selected_files'].add(fname)
-                    st.rerun()
+                st.button(T['btn_selected'] if is_sel else T['btn_select'], key=f"btn_{fname}", type="primary" if is_sel else "secondary",
+                          use_container_width=True, on_click=toggle_selected, args=(fname,))
+        
+        # Наступна сторінка готується у фоні, поки користувач дивиться поточну
+        next_names = visible_names[(page + 1) * page_size:(page + 2) * page_size]
+        if next_names:
+            engine.prefetch_thumbnails([files_map[n] for n in next_names], session=st.session_state['session_id'])
+        
+        p1, p2, p3, p4 = st.columns([1, 2, 1, 1])
+        p1.button("◀", use_container_width=True, disabled=page == 0, on_click=set_gallery_page, args=(page - 1,))
+        p2.markdown(f"<div style='text-align:center;padding-top:6px'>{T['lbl_page'].format(page + 1, pages)}</div>", unsafe_allow_html=True)
+        p3.button("▶", use_container_width=True, disabled=page >= pages - 1, on_click=set_gallery_page, args=(page + 1,))
+        p4.selectbox(T['lbl_page_size'], [12, 24, 48, 96], index=1, key='gallery_page_size_key', on_change=set_gallery_page, args=(0,), label_visibility="collapsed")
 
-        st.caption(f"Files: {len(files_names)} | Selected: {len(st.session_state['selected_files'])}")
+        st.caption(T['grid_stats'].format(len(files_names), len(visible_names), len(st.session_state['selected_files'])))
         
         process_list = list(st.session_state['selected_files'])
         can_process = len(process_list) > 0
@@ -561,75 +779,82 @@ with c_left:
             else:
                 progress = st.progress(0)
                 
-                # --- PREPARE WM (UPDATED FOR PRESETS) ---
-                wm_obj = None
-                try:
-                    if wm_text.strip():
-                        # Text Mode
-                        font_path = None
-                        if selected_font_name:
-                            font_path = os.path.join(os.getcwd(), 'assets', 'fonts', selected_font_name)
-                        wm_obj = engine.create_text_watermark(wm_text, font_path, 100, wm_text_color)
-                        wm_obj = engine.apply_opacity(wm_obj, wm_opacity)
-                    else:
-                        # Image Mode: Check Upload -> Check Preset
-                        wm_bytes = None
-                        if wm_file:
-                            wm_bytes = wm_file.getvalue()
-                        elif st.session_state.get('preset_wm_bytes_key'):
-                            wm_bytes = st.session_state['preset_wm_bytes_key']
-                            
-                        if wm_bytes:
-                            wm_obj = engine.load_watermark_from_file(wm_bytes)
-                            wm_obj = engine.apply_opacity(wm_obj, wm_opacity)
-
-                except Exception as e:
-                    st.error(T['error_wm_load'].format(e))
+                if wm_error:
+                    st.error(T['error_wm_load'].format(wm_error))
                     st.stop()
                 
-                resize_cfg = {
-                    'enabled': resize_on, 'mode': resize_mode, 'value': resize_val,
-                    'wm_scale': wm_scale, 'wm_margin': wm_margin if wm_pos!='tiled' else 0,
-                    'wm_gap': wm_gap if wm_pos=='tiled' else 0,
-                    'wm_position': wm_pos, 'wm_angle': wm_angle
-                }
-                
                 results = []
                 report = []
-                zip_buffer = io.BytesIO()
                 
-                with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-                    futures = {}
-                    for i, fname in enumerate(process_list):
-                        fpath = files_map[fname]
-                        new_fname = engine.generate_filename(fpath, naming_mode, prefix, out_fmt.lower(), i+1)
-                        future = executor.submit(engine.process_image, fpath, new_fname, wm_obj, resize_cfg, out_fmt, quality)
-                        futures[future] = fname
-                    
-                    with zipfile.ZipFile(zip_buffer, "w") as zf:
-                        for i, fut in enumerate(concurrent.futures.as_completed(futures)):
-                            try:
-                                res_bytes, stats = fut.result()
-                                zf.writestr(stats['filename'], res_bytes)
-                                results.append((stats['filename'], res_bytes))
-                                report.append(stats)
-                                del res_bytes
-                                gc.collect()
-                            except Exception as e: st.error(f"Error {futures[fut]}: {e}")
-                            progress.progress((i+1)/len(process_list))
+                # Результати пишуться одразу на диск: RAM не росте з розміром батчу
+                prev = st.session_state.get('results')
+                if prev and os.path.isdir(prev['dir']): shutil.rmtree(prev['dir'], ignore_errors=True)
+                batch_dir = os.path.join(st.session_state['temp_dir'], f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}")
+                out_dir = os.path.join(batch_dir, "files")
+                os.makedirs(out_dir, exist_ok=True)
+                zip_path = os.path.join(batch_dir, "photos.zip")
+                
+                jobs = []
+                for i, fname in enumerate(process_list):
+                    fpath = files_map[fname]
+                    out_paths = [os.path.join(out_dir, name) for name in pipeline.filenames(fpath, naming_mode, prefix, i+1)]
+                    jobs.append((fpath, out_paths if renditions else out_paths[0]))
+                names_by_path = {files_map[fname]: fname for fname in process_list}
                 
-                st.session_state['results'] = {'zip': zip_buffer.getvalue(), 'files': results, 'report': report}
+                memory_budget = engine.MemoryBudget(mem_budget_mb * 2**20) if mem_budget_mb else None
+                with zipfile.ZipFile(zip_path, "w") as zf:
+                    batch = pipeline.run_many(jobs, max_threads, exec_backend, profile=True,
+                                              result_cache=get_result_cache() if use_cache else None,
+                                              memory_budget=memory_budget,
+                                              pool=engine.get_worker_pool(),
+                                              session=st.session_state['session_id'])
+                    for i, (src, stats, err) in enumerate(batch):
+                        if err is None:
+                            for item in (stats if renditions else [stats]):
+                                zf.write(item['output_path'], item['filename'])
+                                results.append((item['filename'], item['output_path']))
+                                report.append(item)
+                        else: st.error(f"Error {names_by_path[src]}: {err}")
+                        progress.progress((i+1)/len(process_list))
+                
+                st.session_state['results'] = {'dir': batch_dir, 'zip_path': zip_path, 'files': results, 'report': report,
+                                               'memory': memory_budget.summary() if memory_budget else None,
+                                               'memory_events': memory_budget.events if memory_budget else []}
                 st.toast(T['msg_done'], icon='🎉')
 
     if 'results' in st.session_state and st.session_state['results']:
         res = st.session_state['results']
         st.success("Batch Processing Complete!")
-        st.download_button(T['btn_dl_zip'], res['zip'], "photos.zip", "application/zip", type="primary")
+        # Файли читаються лише після натискання: інакше кожен rerun клав би ZIP і всі результати в пам'ять Streamlit
+        st.download_button(T['btn_dl_zip'], lambda p=res['zip_path']: read_file(p), "photos.zip", "application/zip", type="primary")
         with st.expander(T['exp_dl_separate']):
-            for name, data in res['files']:
+            for name, path in res['files']:
                 c1, c2 = st.columns([3, 1])
                 c1.write(f"📄 {name}")
-                c2.download_button("⬇️", data, file_name=name, key=f"dl_{name}")
+                c2.download_button("⬇️", lambda p=path: read_file(p), file_name=name, key=f"dl_{name}")
+        if res['report']:
+            with st.expander(T['exp_report']):
+                df = pd.DataFrame(res['report'])
+                st.dataframe(df.drop(columns=['timings', 'output_path'], errors='ignore'), use_container_width=True, hide_index=True)
+                
+                st.caption(T['lbl_report_stages'])
+                stages = pd.DataFrame([r['timings'] for r in res['report'] if 'timings' in r])
+                if not stages.empty:
+                    agg = stages.agg(['sum', 'mean', 'max']).T
+                    agg['share_%'] = agg['sum'] / agg['sum'].sum() * 100
+                    st.dataframe(agg.round(1), use_container_width=True)
+                    m1, m2, m3 = st.columns(3)
+                    m1.metric("Decoded MP", f"{df['decoded_pixels'].sum() / 1e6:.1f}")
+                    m2.metric("Allocated MB", f"{df['alloc_bytes'].sum() / 2**20:.0f}")
+                    if 'cache_hit' in df: m3.metric("Cache hits", f"{int(df['cache_hit'].sum())}/{len(df)}")
+                if res.get('memory'):
+                    mem = res['memory']
+                    st.caption(T['lbl_mem_summary'].format(mem['budget'] / 2**20, mem['peak_bytes'] / 2**20, mem['peak_running'],
+                                                           mem['throttled'], mem['oversize']))
+                    if res['memory_events']:
+                        events = pd.DataFrame(res['memory_events'])
+                        events['file'] = events['file'].map(os.path.basename)
+                        st.dataframe(events, use_container_width=True, hide_index=True)
 
 with c_right:
     st.subheader(T['prev_header'])
@@ -641,40 +866,32 @@ with c_right:
             fpath = files_map[target_file]
             
             # --- LIVE PREVIEW (UPDATED) ---
-            wm_obj = None
-            try:
-                if wm_text.strip():
-                    font_path = None
-                    if selected_font_name:
-                        font_path = os.path.join(os.getcwd(), 'assets', 'fonts', selected_font_name)
-                    wm_obj = engine.create_text_watermark(wm_text, font_path, 100, wm_text_color)
-                    if wm_obj: wm_obj = engine.apply_opacity(wm_obj, wm_opacity)
-                else:
-                    wm_bytes = None
-                    if wm_file: wm_bytes = wm_file.getvalue()
-                    elif st.session_state.get('preset_wm_bytes_key'): wm_bytes = st.session_state['preset_wm_bytes_key']
-                    
-                    if wm_bytes:
-                        wm_obj = engine.load_watermark_from_file(wm_bytes)
-                        if wm_obj: wm_obj = engine.apply_opacity(wm_obj, wm_opacity)
-            except: pass
-            
-            resize_cfg = {
-                'enabled': resize_on, 'mode': resize_mode, 'value': resize_val,
-                'wm_scale': wm_scale, 'wm_margin': wm_margin if wm_pos!='tiled' else 0,
-                'wm_gap': wm_gap if wm_pos=='tiled' else 0,
-                'wm_position': wm_pos, 'wm_angle': wm_angle
-            }
-            
             try:
                 preview_fname = engine.generate_filename(fpath, naming_mode, prefix, out_fmt.lower(), 1)
-                prev_bytes, stats = engine.process_image(fpath, preview_fname, wm_obj, resize_cfg, out_fmt, quality)
+                # Швидкий рендер зі зменшеної копії на кожен rerun
+                # Через спільний пул з інтерактивним пріоритетом: прев'ю не стоїть за чужими батчами
+                pool = engine.get_worker_pool()
+                prev_bytes, stats = pool.submit(pipeline.preview, fpath,
+                                                session=st.session_state['session_id'], priority=engine.PRIORITY_INTERACTIVE).result()
                 
-                st.image(prev_bytes, caption=f"{stats['filename']}", use_container_width=True)
+                st.image(prev_bytes, caption=preview_fname, use_container_width=True)
                 m1, m2 = st.columns(2)
-                delta_size = ((stats['new_size'] - stats['orig_size']) / stats['orig_size']) * 100
                 m1.metric(T['stat_res'], stats['new_res'], stats['scale_factor'])
-                m2.metric(T['stat_size'], f"{stats['new_size']/1024:.1f} KB", f"{delta_size:.1f}%", delta_color="inverse")
+                
+                # Точна вага потребує повного рендера — лише на вимогу, з кешем за налаштуваннями
+                exact_key = json.dumps([fpath, pipeline.config, out_fmt, quality, wm_sig], sort_keys=True, default=str)
+                exact = st.session_state.get('exact_preview')
+                if exact and exact['key'] == exact_key:
+                    exact_stats = exact['stats']
+                    delta_size = ((exact_stats['new_size'] - exact_stats['orig_size']) / exact_stats['orig_size']) * 100
+                    m2.metric(T['stat_size'], f"{exact_stats['new_size']/1024:.1f} KB", f"{delta_size:.1f}%", delta_color="inverse")
+                    if 'target_met' in exact_stats:
+                        st.caption(T['caption_target_q'].format(exact_stats['quality'], T['target_met'] if exact_stats['target_met'] else T['target_missed']))
+                elif m2.button(T['btn_exact_size'], help=T['help_exact_size'], use_container_width=True):
+                    _, exact_stats = pool.submit(pipeline.render, fpath, preview_fname,
+                                                 session=st.session_state['session_id'], priority=engine.PRIORITY_INTERACTIVE).result()
+                    st.session_state['exact_preview'] = {'key': exact_key, 'stats': exact_stats}
+                    st.rerun()
             except Exception as e: st.error(f"Preview Error: {e}")
         else:
             st.markdown(f"""<div class="preview-placeholder"><span class="preview-icon">🖼️</span><p>{T['prev_placeholder']}</p></div>""", unsafe_allow_html=True)